@@ -1,29 +1,353 @@
+import collections
+import concurrent.futures
+import copy
 import datetime
+import functools
+import gc
+import hashlib
+import io
+import multiprocessing
+import pickle
+import re
 import time
+import traceback
 import sys
 import shutil
 import os
-from xml.etree import ElementTree
 from xml.etree.ElementTree import Element, SubElement
-from xml.dom import minidom
+import numpy
 import pandas
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
 
 __author__ = "Timothy Cameron"
 __email__ = "tcameron@devtechsys.com"
 __date__ = "12-06-2018"
 __version__ = "0.39a"
 date = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]+'Z'
+# Run with --reparse to ignore the cached copies of the input files and read the Excel files again.
+force_reparse = '--reparse' in sys.argv
+# Run with --parallel-load to read the input files at the same time, one process for each file.
+parallel_load = '--parallel-load' in sys.argv
+# Run with --lxml to build and print the activities with lxml, when it is installed, instead of ElementTree.
+# Both give the same files, but lxml's output has to be fixed up to match, so it is not faster yet.
+use_lxml = etree is not None and '--lxml' in sys.argv
+# Run with --rebuild to build every file again, even the ones whose rows have not changed since the last run.
+force_rebuild = '--rebuild' in sys.argv
+# The hash of the rows of each file the last runs wrote, and where they wrote it.
+manifest_file = 'export/manifest'
+# Run with --workers=N to write the recipient files in N worker processes at the same time.
+workers = int(next((arg[len('--workers='):] for arg in sys.argv if arg.startswith('--workers=')), '1'))
+# Add --fragments to split each file's activities between the workers instead of handing each worker a whole file.
+# A run with only one file always does this.
+split_fragments = '--fragments' in sys.argv
+# The number of hierarchy 1 activities a worker builds at a time, and how many of those runs each worker may have
+# waiting to be written.
+run_size = 50
+runs_per_worker = 4
+
+# The columns read from each input file and the type to read them as.
+# 'object' is used for text, and None leaves the type to pandas. Codes, dates and amounts are left to pandas too and
+# read as numbers where they are used, so a cell with text in it gets the same fallback as before.
+schema = {'omb': {'DAC Regional Code': None,
+                  'ISO Alpha Code': 'object',
+                  'DAC Country Code': None,
+                  'DAC Country Name': 'object',
+                  'Implementing Mechanism ID': None,
+                  'Appropriated Agency': 'object',
+                  'Implementing Mechanism Purpose Statement': 'object',
+                  'Clean ID': None,
+                  'Clean OU Name': None,
+                  'Implementing Mechanism Title': 'object',
+                  'Implementing Agent': 'object',
+                  'IATI Organization ID': None,
+                  'Implementing Agent Type': None,
+                  'Reporting Status': None,
+                  'Start Date': None,
+                  'start_date_narr': 'object',
+                  'End Date': None,
+                  'end_date_narr': 'object',
+                  'Activity Scope': None,
+                  'Implementing Mechanism Signing Date': None,
+                  'USAID contact name': 'object',
+                  'USAID contact telephone': None,
+                  'USAID contact email': 'object',
+                  'Activity Website': 'object',
+                  'USAID contact address': 'object',
+                  'Collaboration Type Code': None,
+                  'Collaboration Type': 'object',
+                  'Flow Type': None,
+                  'Finance Type': None,
+                  'Aid Type Code': 'object',
+                  'Tying Status of Award': None,
+                  'Beginning Fiscal Funding Year': None,
+                  'Ending Fiscal Funding Year': None,
+                  'Total allocations': None,
+                  'Award Transaction Value': None,
+                  'Award Transaction - Description': 'object',
+                  'Award Transaction Type': 'object',
+                  'Award Transaction Date': None,
+                  'Treasury Regular Account Code': None,
+                  'Treasury Main Account Code': None,
+                  'Treasury Main Account Title': 'object',
+                  'Humanitarian Tag': None,
+                  'Disbursement Channel': None,
+                  'DAC Purpose Code': None,
+                  'U.S. Government Sector Code': None,
+                  'DAC Purpose Name': 'object',
+                  'U.S. Government Sector Name': 'object',
+                  'Cluster ID': None,
+                  "Implementing Agent's DUNS Number": None,
+                  'TEC': None,
+                  'State Location': 'object',
+                  'Award Transaction ID': None,
+                  'clean_id': None},
+          'location': {'clean_id': None,
+                       'iso_alpha_code': None,
+                       'dac_regional_code': None,
+                       'District': 'object',
+                       'location_coordinates': 'object',
+                       'location_reach': None,
+                       'location_type': None},
+          'document': {'clean_id': None,
+                       'Activity Title': 'object',
+                       'file': 'object',
+                       'doc_format': 'object',
+                       'doc_category': 'object',
+                       'Lang_code': 'object',
+                       'pubdate': None},
+          # The historical codes are compared to the recipient code as they are, so they keep their own type.
+          'historical': {'Implementing Mechanism ID': None,
+                         'DAC Regional Code': None,
+                         'ISO Alpha Code': None,
+                         'Award Transaction Type': 'object',
+                         'Award Transaction Value': None,
+                         'Award Transaction Date': None,
+                         'DAC Purpose Code': None},
+          'results': {'Clean ID': None,
+                      'results': 'object',
+                      'results_title': 'object',
+                      'results_indicator': 'object',
+                      'objectives': 'object'}}
+
+# The namespaces used in the XML. Names in them are given in ElementTree's {namespace}name form,
+# and write_pretty writes them with these prefixes.
+fasite = 'https://explorer.usaid.gov/'
+xmlsite = 'http://www.w3.org/XML/1998/namespace'
+prefixes = {fasite: 'usg', xmlsite: 'xml'}
+usg = '{' + fasite + '}'
+xmllang = '{' + xmlsite + '}lang'
+# The namespaces the root declares, as they are written in its start tag. The xml prefix never needs declaring.
+nsmap = {prefix: namespace for namespace, prefix in prefixes.items() if prefix != 'xml'}
+declarations = ''.join(' xmlns:' + prefix + '="' + namespace + '"' for prefix, namespace in nsmap.items())
+
+if use_lxml:
+    # With nsmap on every new tree, lxml writes the namespaced elements with the same prefixes
+    Element = functools.partial(etree.Element, nsmap=nsmap)
+    SubElement = etree.SubElement
+
+# Elements that are the same everywhere they are used, like the reporting-org, are only built once by
+# constant and added as they are to every activity. write_pretty keeps their printed text in fragments,
+# for each indent, so they are only printed once too. lxml elements can only have one parent, so with lxml
+# each activity gets its own copy instead.
+constants = {}
+fragments = {}
+
+# The omb file is turned into these row records, read by attribute. The attributes are the column names
+# with everything but letters and numbers turned into _, so omb["Start Date"][i] is rows[i].Start_Date.
+# The columns added by omb_dates and omb_amounts come after them.
+date_columns = ['start_date_iso', 'start_date_text', 'end_date_iso', 'end_date_text', 'signing_date_iso',
+                'transaction_date_iso', 'period_start_iso', 'period_end_iso', 'funding_year_begin', 'funding_year_end']
+amount_columns = ['budget_amount', 'transaction_amount', 'tec_amount']
+OmbRow = collections.namedtuple('OmbRow', [re.sub(r'\W+', '_', column).strip('_') for column in schema['omb']] +
+                                date_columns + amount_columns)
+
+
+def constant(tag, attrib, text=None):
+    """
+    Return the shared element for a subtree that is the same in every activity, building it the first time.
+    The element must not be changed, as it is added as it is to every activity that uses it.
+    :param tag: The tag of the element.
+    :param attrib: The attributes of the element, in the order they are written.
+    :param text: The text of the element's narrative, or None for an element without one.
+    :return elem: The shared element.
+    """
+    key = (tag, tuple(attrib.items()), text)
+    elem = constants.get(key)
+    if elem is None:
+        elem = Element(tag, attrib)
+        if text is not None:
+            narrative = SubElement(elem, 'narrative')
+            narrative.text = text
+        constants[key] = elem
+        fragments[elem] = {}
+    if use_lxml:
+        return copy.deepcopy(elem)
+    return elem
+
+
+def prettify_start(elem, close=False):
+    """
+    Return the pretty-printed declaration and start tag of the root, so its activities can follow one at a time.
+    :param elem: The root of the XML tree, without any activities added to it.
+    :param close: Set to True to close the root straight away, for a file with no activities.
+    :return writer: The pretty-printed start of the file.
+    """
+    writer = io.StringIO()
+    writer.write('<?xml version="1.0" ?>\n<' + elem.tag)
+    for name, value in elem.items():
+        writer.write(" " + qualified_name(name) + "=\"" + escape_data(value) + "\"")
+    writer.write(declarations + ("/>\n" if close else ">\n"))
+    return writer.getvalue()
+
+
+def prettify_activity(elem):
+    """
+    Return a pretty-printed string for one activity, indented the same as it would be inside the root.
+    :param elem: The activity's XML tree.
+    :return writer: The pretty-printed string from the activity's XML tree.
+    """
+    if use_lxml:
+        return lxml_activity(elem)
+    writer = io.StringIO()
+    write_pretty(writer, elem, "  ")
+    return writer.getvalue()
+
+
+def lxml_activity(elem):
+    """
+    Return a pretty-printed string for one activity built with lxml, in exactly the layout write_pretty gives.
+    :param elem: The activity's lxml tree.
+    :return text: The pretty-printed string from the activity's XML tree.
+    """
+    etree.indent(elem, space="  ", level=1)
+    text = "  " + etree.tostring(elem, encoding='unicode').replace(declarations, '', 1) + "\n"
+    # lxml writes text and attributes a little differently, so those places are changed to match
+    text = lxml_quoted.sub(lxml_text_fix, text)
+    if '&#' in text:
+        text = lxml_text.sub(lxml_text_fix, text)
+        text = lxml_attribute.sub(lxml_attribute_fix, text)
+    if '></' in text:
+        text = lxml_empty.sub(r'<\1\2/>', text)
+    return text
+
+
+# The text between two tags with a " in it, any text between two tags, the value of an attribute,
+# and an element with empty text, in lxml's output
+lxml_quoted = re.compile(r'>[^<"]*"[^<]*<')
+lxml_text = re.compile(r'>[^<]*<')
+lxml_attribute = re.compile(r'="[^"]*"')
+lxml_empty = re.compile(r'<([^\s/>]+)([^>]*)></\1>')
+
+
+def lxml_text_fix(match):
+    """
+    Escape " in text and write its line breaks as LF, as write_pretty does.
+    :param match: The text between two tags.
+    :return text: The changed text.
+    """
+    return match.group(0).replace('"', '&quot;').replace('&#13;\n', '\n').replace('&#13;', '\n')
 
 
-def prettify(elem):
+def lxml_attribute_fix(match):
+    """
+    Leave line breaks and tabs in an attribute as they are, as write_pretty does.
+    :param match: The attribute value.
+    :return text: The changed value.
+    """
+    return match.group(0).replace('&#10;', '\n').replace('&#13;', '\r').replace('&#9;', '\t')
+
+
+def escape_data(text):
+    """
+    Escape text for the XML the same way minidom does.
+    :param text: The text or attribute value.
+    :return text: The escaped text.
     """
-    Return a pretty-printed string for the xml elements.
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def line_breaks(text):
+    """
+    Turn CR LF and CR line breaks in text into LF, the way the XML parser did when the files went through minidom.
+    :param text: The text of an element, or None.
+    :return text: The text with its line breaks changed, or '' for None.
+    """
+    if not text:
+        return ''
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def qualified_name(name):
+    """
+    Return the name as it is written in the XML, with the prefix of its namespace if it has one.
+    :param name: The tag or attribute name, like "{https://explorer.usaid.gov/}tec1".
+    :return name: The name with its prefix, like "usg:tec1".
+    """
+    if name[:1] != "{":
+        return name
+    namespace, local = name[1:].split("}", 1)
+    return prefixes[namespace] + ":" + local
+
+
+def write_pretty(writer, elem, indent):
+    """
+    Write an element and everything in it in one pass, with the same layout as minidom's toprettyxml.
+    An element with only text is kept on one line, and an empty element is closed with />.
+    :param writer: The file or string to write to.
     :param elem: The current XML tree.
-    :return reparsed: The pretty-printed string from the XML tree.
+    :param indent: The indent in front of the element.
     """
-    rough_string = ElementTree.tostring(elem, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    return reparsed.toprettyxml(indent="  ")
+    tag = qualified_name(elem.tag)
+    writer.write(indent + "<" + tag)
+    for name, value in elem.items():
+        writer.write(" " + qualified_name(name) + "=\"" + escape_data(value) + "\"")
+    text = line_breaks(elem.text)
+    if not len(elem):
+        if text:
+            writer.write(">" + escape_data(text) + "</" + tag + ">\n")
+        else:
+            writer.write("/>\n")
+        return
+    writer.write(">\n")
+    inner = indent + "  "
+    if text:
+        writer.write(escape_data(inner + text + "\n"))
+    for child in elem:
+        printed = fragments.get(child)
+        if printed is None:
+            write_pretty(writer, child, inner)
+        else:
+            if inner not in printed:
+                fragment = io.StringIO()
+                write_pretty(fragment, child, inner)
+                printed[inner] = fragment.getvalue()
+            writer.write(printed[inner])
+        tail = line_breaks(child.tail)
+        if tail:
+            writer.write(escape_data(inner + tail + "\n"))
+    writer.write(indent + "</" + tag + ">\n")
+
+
+def recipient_codes(ombfile):
+    """
+    Return the recipient country or region code for every row, worked out a whole column at a time.
+    The DAC Regional Code is used first, then the ISO Alpha Code, then '998'.
+    :param ombfile: The source file to grab the data from
+    :return countries: The recipient code of each row
+    """
+    regions = numbers(ombfile["DAC Regional Code"])
+    isos = ombfile["ISO Alpha Code"].map(str)
+    countries = pandas.Series('998', index=ombfile.index, dtype=object)
+    # This is due to Namibia's code being "NA", but numpy counts "NA" as not applicable, so it gets skipped
+    namibia = numpy.trunc(numbers(ombfile["DAC Country Code"])) == 275
+    countries[namibia] = 'NA'  # Being used as a temporary stopgap
+    countries = countries.where(isos == 'nan', isos)
+    regional = regions.notna()
+    countries[regional] = regions[regional].astype('int64').astype(str)
+    return countries
 
 
 def id_loop(ombfile):
@@ -34,118 +358,196 @@ def id_loop(ombfile):
     :return idswawards: The sub-activity identifiers
     :return isos: The ISO-3166 country codes for each activity
     """
-    ids = list()
-    idswawards = list()
-    isos = list()
     # USAID is identified as US-GOV-1 within IATI.
     code = '1'
-    for i in range(0, len(ombfile.index)):
-        try:
-            country = str(int(ombfile["DAC Regional Code"][i]))
-        except ValueError:
-            if str(ombfile["ISO Alpha Code"][i]) != 'nan':
-                try:
-                    country = str(ombfile["ISO Alpha Code"][i])
-                except ValueError:
-                    country = '998'
-            else:
-                # This is due to Namibia's code being "NA", but numpy counts "NA" as not applicable, so it gets skipped
-                try:
-                    namibia = str(int(ombfile["DAC Country Code"][i]))
-                    if namibia == '275':  # Being used as a temporary stopgap
-                        country = 'NA'
-                    else:
-                        country = '998'
-                except ValueError:
-                    country = '998'
-        awardid = str(omb["Implementing Mechanism ID"][i])
-        entry = 'US-GOV' + '-' + code + '-' + country
-        ids.append(entry)
-        entry += '-' + awardid
-        idswawards.append(entry)
-        isos.append(country)
-    return ids, idswawards, isos
+    countries = recipient_codes(ombfile)
+    ids = 'US-GOV' + '-' + code + '-' + countries
+    idswawards = ids + '-' + ombfile["Implementing Mechanism ID"].map(str)
+    return ids.tolist(), idswawards.tolist(), countries.tolist()
 
 
 def group_split(ombfile):
     """
     Return lists of separate recipients and the ids for each row.
     :param ombfile: The source file to grab the data from
-    :return ids: The main activity identifiers
+    :return ids: The recipient code of each group followed by its row numbers, in the order first seen
     """
-    actives = list()
-    ids = list()
-    for i in range(0, len(ombfile.index)):
-        try:
-            country = str(int(ombfile["DAC Regional Code"][i]))
-        except ValueError:
-            if str(ombfile["ISO Alpha Code"][i]) != 'nan':
-                try:
-                    country = str(ombfile["ISO Alpha Code"][i])
-                except ValueError:
-                    country = '998'
-            else:
-                try:
-                    namibia = str(int(ombfile["DAC Country Code"][i]))
-                    if namibia == '275':  # Being used as a temporary stopgap
-                        country = 'NA'
-                    else:
-                        country = '998'
-                except ValueError:
-                    country = '998'
-        if country not in actives:
-            actives.append(country)
-            ids.append([country, i])
+    groups = {}
+    for i, country in enumerate(recipient_codes(ombfile)):
+        if country in groups:
+            groups[country].append(i)
         else:
-            for each in ids:
-                if country == each[0]:
-                    each.append(i)
-    return ids
+            groups[country] = [country, i]
+    return list(groups.values())
+
+
+def read_number(cell, convert=int):
+    """
+    Read one cell with int() or float(), as the activities used to.
+    :param cell: The value of the cell
+    :param convert: int or float
+    :return number: The number, or NaN where the cell cannot be read
+    """
+    try:
+        return float(convert(cell))
+    except ValueError:
+        return numpy.nan
+
+
+def numbers(column, convert=int):
+    """
+    Read a column as numbers all at once, the way convert() reads each cell.
+    A column that pandas read as numbers is used as it is. In a column with text in it, the cells that cannot be read
+    become NaN like blank cells, so they get the same fallback as a blank cell.
+    :param column: The column to read
+    :param convert: int or float, whichever the column is read with
+    :return numbers: The column as float64
+    """
+    if column.dtype != object:
+        return column.astype('float64')
+    return column.map(functools.partial(read_number, convert=convert)).astype('float64')
+
+
+def iso_dates(column, fallback=''):
+    """
+    Convert a column of YYYYMMDD numbers into YYYY-MM-DD strings all at once.
+    :param column: The column of dates
+    :param fallback: The text used where the date is blank, or a column with the text for each row
+    :return dates: The formatted dates
+    """
+    column = numbers(column)
+    dates = pandas.Series(fallback, index=column.index, dtype=object)
+    known = column.notna()
+    digits = column[known].astype('int64').astype(str)
+    dates[known] = digits.str[0:4] + '-' + digits.str[4:6] + '-' + digits.str[6:8]
+    return dates
+
+
+def fiscal_years(column, fallback='', suffix=''):
+    """
+    Convert a column of fiscal years into text all at once.
+    :param column: The column of years
+    :param fallback: The text used where the year is blank
+    :param suffix: The text added after every year that is not blank, such as a month and day
+    :return years: The years as text
+    """
+    column = numbers(column)
+    years = pandas.Series(fallback, index=column.index, dtype=object)
+    known = column.notna()
+    years[known] = column[known].astype('int64').astype(str) + suffix
+    return years
+
+
+def omb_dates(ombfile):
+    """
+    Add the formatted dates of every row to the omb file, so the activities only read the finished text.
+    Blank dates get the same defaults as before: the start of this or last fiscal year.
+    :param ombfile: The omb file, which gets the date_columns added to it
+    """
+    this_year = int(datetime.datetime.utcnow().strftime('%Y'))
+    last_fy_start = str(this_year - 1) + '-10-01'
+    start_known = numbers(ombfile["Start Date"]).notna()
+    end_known = numbers(ombfile["End Date"]).notna()
+    ombfile['start_date_iso'] = iso_dates(ombfile["Start Date"], last_fy_start)
+    ombfile['start_date_text'] = ombfile["start_date_narr"].astype(str).where(~start_known, '')
+    ombfile['end_date_iso'] = iso_dates(ombfile["End Date"], str(this_year) + '-10-01')
+    ombfile['end_date_text'] = ombfile["end_date_narr"].astype(str).where(~end_known, '')
+    ombfile['signing_date_iso'] = iso_dates(ombfile["Implementing Mechanism Signing Date"], last_fy_start)
+    ombfile['transaction_date_iso'] = iso_dates(ombfile["Award Transaction Date"], last_fy_start)
+    # The budget period falls back on the funding years, and is left blank when those are missing too
+    period_start = fiscal_years(ombfile["Beginning Fiscal Funding Year"], suffix='-10-01')
+    period_end = fiscal_years(ombfile["Ending Fiscal Funding Year"], suffix='-09-30')
+    ombfile['period_start_iso'] = iso_dates(ombfile["Start Date"], period_start)
+    ombfile['period_end_iso'] = iso_dates(ombfile["End Date"], period_end)
+    ombfile['funding_year_begin'] = fiscal_years(ombfile["Beginning Fiscal Funding Year"], str(this_year - 1))
+    ombfile['funding_year_end'] = fiscal_years(ombfile["Ending Fiscal Funding Year"], str(this_year))
+
+
+def money_text(column, blank='nan', invalid='0.00'):
+    """
+    Format a column of amounts as text with two decimals all at once.
+    :param column: The column of amounts
+    :param blank: The text used where the amount is blank
+    :param invalid: The text used where the cell has something in it that is not an amount
+    :return amounts: The amounts as text
+    """
+    filled = column.notna().to_numpy()
+    column = numbers(column, float)
+    missing = column.isna().to_numpy()
+    amounts = numpy.char.mod('%.2f', column.to_numpy(dtype='float64')).astype(object)
+    amounts[missing] = blank
+    amounts[missing & filled] = invalid
+    return pandas.Series(amounts, index=column.index)
+
+
+def omb_amounts(ombfile):
+    """
+    Add the formatted amounts of every row to the omb file, so the activities only read the finished text.
+    The original columns are kept as numbers for anything that needs to add them up.
+    :param ombfile: The omb file, which gets the amount_columns added to it
+    """
+    ombfile['budget_amount'] = money_text(ombfile["Total allocations"], '0.00')
+    ombfile['transaction_amount'] = money_text(ombfile["Award Transaction Value"])
+    ombfile['tec_amount'] = money_text(ombfile["TEC"])
+
+
+def omb_records(ombfile):
+    """
+    Convert the omb file into a list of row records, so each value is read without a pandas lookup.
+    :param ombfile: The source file to grab the data from
+    :return rows: An OmbRow for each row of the file, with its date_columns and amount_columns
+    """
+    columns = [ombfile[column].tolist() for column in list(schema['omb']) + date_columns + amount_columns]
+    return [OmbRow._make(values) for values in zip(*columns)]
 
 
 def activities_loop(allids):
     """
     Find which activities are the main ones to set as hierarchy 1.
     :param allids: All of the identifiers, without the award numbers.
-    :return rows: The index numbers corresponding to the rows.
+    :return rows: The index numbers corresponding to the rows, in order, mapped to their identifiers.
     """
-    rows = list()
-    actives = list()
+    # A dict keeps the rows in order and checks membership without scanning them.
+    rows = {}
+    actives = set()
     for i in range(0, len(allids)):
         if allids[i] not in actives:
-            actives.append(allids[i])
-            rows.append(i)
+            actives.add(allids[i])
+            rows[i] = allids[i]
     return rows
 
 
-def related_loop(theomb, theombawards, iden):
+def related_dict(theomb, theombawards):
     """
-    Find which activities are related to the main ones.
+    Find which activities are related to each of the main ones, in one pass over the rows.
     :param theomb: The list of hierarchy 1 activities.
     :param theombawards: The list of every row with their own awards.
-    :param iden: The current hierarchy 1 activity to relate to.
-    :return related: The index numbers of the related activities.
+    :return related: The index numbers of the related activities for each hierarchy 1 activity.
     """
-    related = list()
-    relateds = list()
+    related = {}
+    relateds = set()
     for i in range(0, len(theomb)):
-        if iden == theomb[i] and theombawards[i] not in relateds:
-            relateds.append(theombawards[i])
-            related.append(i)
+        if (theomb[i], theombawards[i]) not in relateds:
+            relateds.add((theomb[i], theombawards[i]))
+            if theomb[i] in related:
+                related[theomb[i]].append(i)
+            else:
+                related[theomb[i]] = [i]
     return related
 
 
-def trans_loop(idawarded, award):
+def trans_dict(idawarded):
     """
-    Finds all transactions sharing the current activity's award ID.
+    Finds the transactions of every award, in one pass over the rows.
     :param idawarded: The list of activities with the proper award num.
-    :param award: The current award number to look for.
-    :return transactions: Index numbers of the related transactions.
+    :return transactions: Index numbers of the transactions for each award.
     """
-    transactions = list()
+    transactions = {}
     for i in range(0, len(idawarded)):
-        if award == idawarded[i]:
-            transactions.append(i)
+        if idawarded[i] in transactions:
+            transactions[idawarded[i]].append(i)
+        else:
+            transactions[idawarded[i]] = [i]
     return transactions
 
 
@@ -160,187 +562,187 @@ def cluster_loop(clustercodes, transelement):
     vocaburi = ""
     clusterlist = clustercodes.split(';')
     for code in clusterlist:
-        SubElement(transelement, 'sector', code=code, vocabulary="10", vocabulary_h_uri=vocaburi)
+        transelement.append(constant('sector', {'code': code, 'vocabulary': "10", 'vocabulary-uri': vocaburi}))
 
 
-def historical_loop(hist_dict, cleanou, histcode, histfile):
+def historical_dict(histfile):
     """
-    Finds all transactions sharing the current activity's clean OU.
-    :param hist_dict: The dictionary of activities with the proper clean OU.
-    :param cleanou: The current clean OU to look for.
-    :param histcode: The region or country code to match with.
+    Create a dictionary of the historical transactions for each award and recipient, formatted once.
+    A row is filed under its DAC Regional Code and under its ISO Alpha Code.
     :param histfile: The historical data file.
-    :return transaction: Index numbers of the related transactions.
+    :return hist_dict: The [type, value, date, DAC code] of the transactions for each (award, recipient code).
     """
-    hists = []
-    temphist = []
+    start = time.time()
+    hist_dict = {}
+    for award, region, iso, transtype, histvalue, formattedhistdate, dachist in zip(
+            histfile["Implementing Mechanism ID"].tolist(), histfile["DAC Regional Code"].tolist(),
+            histfile["ISO Alpha Code"].tolist(), histfile["Award Transaction Type"].tolist(),
+            money_text(histfile["Award Transaction Value"]).tolist(),
+            iso_dates(histfile["Award Transaction Date"]).tolist(), histfile["DAC Purpose Code"].tolist()):
 
-    try:
-        for i in range(0, len(hist_dict[cleanou])):
-            if histfile["DAC Regional Code"][hist_dict[cleanou][i]] == histcode or\
-                    histfile["ISO Alpha Code"][hist_dict[cleanou][i]] == histcode:
-                temphist.append(str(histfile["Award Transaction Type"][hist_dict[cleanou][i]]))
-                try:
-                    histamount = float(histfile["Award Transaction Value"][hist_dict[cleanou][i]])
-                    histvalue = str('{0:.2f}'.format(histamount))
-                except ValueError:
-                    histvalue = '0.00'
-                temphist.append(histvalue)
+        # DAC Sectors
+        try:
+            dachistcode = str(int(dachist))
+        except ValueError:
+            dachistcode = '0'
+
+        temphist = [str(transtype), histvalue, formattedhistdate, dachistcode]
+        keys = [(award, region)]
+        if iso != region:
+            keys.append((award, iso))
+        for key in keys:
+            if key in hist_dict:
+                hist_dict[key].append(temphist)
+            else:
+                hist_dict[key] = [temphist]
+    index_summary('historical data file', hist_dict, start)
+    return hist_dict
 
-                try:
-                    hist_date = str(int(histfile["Award Transaction Date"][hist_dict[cleanou][i]]))
-                    formattedhistdate = hist_date[0:4] + '-' + hist_date[4:6] + '-' + hist_date[6:8]
-                    temphist.append(formattedhistdate)
-                except ValueError:
-                    temphist.append('')
 
-                # DAC Sectors
-                try:
-                    dachistcode = str(int(histfile["DAC Purpose Code"][hist_dict[cleanou][i]]))
-                except ValueError:
-                    dachistcode = '0'
-                temphist.append(dachistcode)
+def index_summary(description, index, start):
+    """
+    Print the size of a dictionary made from a mapping file and how long it took to make.
+    :param description: the name of the file for the summary.
+    :param index: the dict of rows for each key.
+    :param start: the time the dict was started.
+    :return: N/A
+    """
+    fanout = max([len(rows) for rows in index.values()] or [0])
+    print('Indexed the {0}: {1} keys, at most {2} rows for a key, {3:.3f} seconds'.format(
+        description, len(index), fanout, time.time() - start))
 
-                hists.append(temphist)
-                temphist = []
-    except KeyError:
-        return []
 
-    return hists
+def index_dict(mapfile, column, description):
+    """
+    Create a dictionary of the rows holding each value of a column, and print a summary of it.
+    :param mapfile: the mapping file to index.
+    :param column: the column to index the rows by.
+    :param description: the name of the file for the summary.
+    :return index: the dict of row numbers for each value, in file order
+    """
+    start = time.time()
+    groups = mapfile.groupby(column, sort=False).indices
+    index = dict((key, rows.tolist()) for key, rows in groups.items())
+    index_summary(description, index, start)
+    return index
 
 
-def dictfiles(locfile, docfile, histfile, resfile):
+def dictfiles(docfile, resfile):
     """
     Create dictionaries for faster access of the mapping files.
-    :param locfile: the location file to use for mapping.
+    The location and historical data files have their own dictionaries from location_dict and historical_dict.
     :param docfile: the document file to use for mapping.
-    :param histfile: the historical data file to use for mapping.
     :param resfile: the results data file to use for mapping.
-    :return loc_dict: the dict of locations
     :return doc_dict: the dict of documents
-    :return hist_dict: the dict of historical data
     :return res_dict: the dict of the results and objectives data
     """
-    loc_dict = {}
-    doc_dict = {}
-    hist_dict = {}
-    res_dict = {}
-
-    for i in range(0, len(locfile.index)):
-        if locfile["clean_id"][i] in loc_dict:
-            loc_dict[locfile["clean_id"][i]].append(i)
-        else:
-            loc_dict[locfile["clean_id"][i]] = [i]
-    for j in range(0, len(docfile.index)):
-        if docfile["clean_id"][j] in doc_dict:
-            doc_dict[docfile["clean_id"][j]].append(j)
-        else:
-            doc_dict[docfile["clean_id"][j]] = [j]
-    for h in range(0, len(histfile.index)):
-        if histfile["Implementing Mechanism ID"][h] in hist_dict:
-            hist_dict[histfile["Implementing Mechanism ID"][h]].append(h)
-        else:
-            hist_dict[histfile["Implementing Mechanism ID"][h]] = [h]
-    for r in range(0, len(resfile.index)):
-        if resfile["Clean ID"][r] in res_dict:
-            res_dict[resfile["Clean ID"][r]].append(r)
-        else:
-            res_dict[resfile["Clean ID"][r]] = [r]
-    print(loc_dict)
-    print(doc_dict)
-    print(hist_dict)
-    print(res_dict)
-    return loc_dict, doc_dict, hist_dict, res_dict
+    doc_dict = index_dict(docfile, "clean_id", 'document file')
+    res_dict = index_dict(resfile, "Clean ID", 'results data file')
+    return doc_dict, res_dict
 
 
-def location_loop(locfile, cleanid, locmap, loc_dict):
+def location_dict(locfile):
     """
-    Create a list of sub-national locations for an activity.
+    Create a dictionary of the sub-national locations for each award and recipient, formatted once.
+    A row is filed under its ISO Alpha Code and under its DAC Regional Code.
     :param locfile: the location file to use for mapping.
-    :param cleanid: the clean id of the award to map to.
-    :param locmap: the ISO Alpha Code or DAC Regional Code of the award to map to.
-    :param loc_dict: the dictionary holding the index to map to.
-    :return locs: the list of locations to insert into the XML
+    :return loc_dict: the [name, coordinates, reach, exactness, class] of the locations for each (clean id, code)
     """
-    locs = []
-    temploc = []
+    start = time.time()
+    loc_dict = {}
     location_exact = "2"  # 1 is exact, 2 is approximate
-    for i in range(0, len(loc_dict[cleanid])):
-        if str(locfile["iso_alpha_code"][loc_dict[cleanid][i]]) == locmap \
-                or str(locfile["dac_regional_code"][loc_dict[cleanid][i]]) == locmap:
-
-            temploc.append(str(locfile["District"][loc_dict[cleanid][i]]))
-            temploc.append(str(locfile["location_coordinates"][loc_dict[cleanid][i]]))
-            try:
-                temploc.append(str(int(locfile["location_reach"][loc_dict[cleanid][i]])))
-            except ValueError:
-                temploc.append('2')
-            temploc.append(location_exact)
-            temploc.append(str(int(locfile["location_type"][loc_dict[cleanid][i]])))
-            locs.append(temploc)
-            temploc = []
-    return locs
-
-
-def docs_loop(docfile, cleanid, doc_dict):
-    """
-    Create a list of documents for an activity.
-    :param docfile: the documents file to use for mapping.
-    :param cleanid: the clean id of the award to map to.
-    :param doc_dict: the dictionary holding the index to map to.
-    :return docs: the list of documents to insert into the XML
-    """
-    # Title, URL, Format, Category, Language
-    docs = []
-    tempdoc = []
-
-    for i in range(0, len(doc_dict[cleanid])):
-        tempdoc.append(str(docfile["Activity Title"][doc_dict[cleanid][i]]))
-        tempdoc.append(str(docfile["file"][doc_dict[cleanid][i]]))
-        tempdoc.append(str(docfile["doc_format"][doc_dict[cleanid][i]]))
-        tempdoc.append(str(docfile["doc_category"][doc_dict[cleanid][i]]))
-        tempdoc.append(str(docfile["Lang_code"][doc_dict[cleanid][i]]))
-
+    for cleanid, iso, region, district, coordinates, locreach, loctype in zip(
+            locfile["clean_id"].tolist(), locfile["iso_alpha_code"].tolist(),
+            locfile["dac_regional_code"].tolist(), locfile["District"].tolist(),
+            locfile["location_coordinates"].tolist(), locfile["location_reach"].tolist(),
+            locfile["location_type"].tolist()):
+        try:
+            reach = str(int(locreach))
+        except ValueError:
+            reach = '2'
         try:
-            doc_date = str(int(docfile["pubdate"][doc_dict[cleanid][i]]))
-            formatteddocdate = doc_date[0:4] + '-' + doc_date[4:6] + '-' + doc_date[6:8]
-            tempdoc.append(formatteddocdate)
+            locclass = str(int(loctype))
         except ValueError:
-            tempdoc.append('')
+            # There is no class to publish for a location without a type, so it is left out
+            print('Skipping a location of ' + str(cleanid) + ' with no location type: ' + str(district))
+            continue
+        temploc = [str(district), str(coordinates), reach, location_exact, locclass]
+        keys = [(cleanid, str(iso))]
+        if str(region) != str(iso):
+            keys.append((cleanid, str(region)))
+        for key in keys:
+            if key in loc_dict:
+                loc_dict[key].append(temploc)
+            else:
+                loc_dict[key] = [temploc]
+    index_summary('location file', loc_dict, start)
+    return loc_dict
 
-        docs.append(tempdoc)
-        tempdoc = []
 
+def document_rows(docfile):
+    """
+    Create a list of every document in the documents file, formatted once.
+    :param docfile: the documents file to use for mapping.
+    :return docs: the [title, url, format, category, language, date] of each row
+    """
+    # Title, URL, Format, Category, Language
+    docs = []
+    for title, url, docformat, category, lang, formatteddocdate in zip(
+            docfile["Activity Title"].tolist(), docfile["file"].tolist(), docfile["doc_format"].tolist(),
+            docfile["doc_category"].tolist(), docfile["Lang_code"].tolist(), iso_dates(docfile["pubdate"]).tolist()):
+        docs.append([str(title), str(url), str(docformat), str(category), str(lang), formatteddocdate])
     return docs
 
 
-def results_loop(resfile, cleanid, res_dict):
+def result_rows(resfile):
     """
-    Create a list of documents for an activity.
+    Create lists of every result and objective in the results file, formatted once.
     :param resfile: the results file to use for mapping.
-    :param cleanid: the clean id of the award to map to.
-    :param res_dict: the dictionary holding the index to map to.
-    :return results: the list of results and objectives to insert into the XML
+    :return resu: the [results, title, indicator] of each row
+    :return obje: the [objective] of each row
     """
-    # Title, URL, Format, Category, Language
     resu = []
-    tempres = []
     obje = []
-    tempobj = []
-
-    for i in range(0, len(res_dict[cleanid])):
-        tempres.append(str(resfile["results"][res_dict[cleanid][i]]))
-        tempres.append(str(resfile["results_title"][res_dict[cleanid][i]]))
-        tempres.append(str(resfile["results_indicator"][res_dict[cleanid][i]]))
-        tempobj.append(str(resfile["objectives"][res_dict[cleanid][i]]))
-
-        resu.append(tempres)
-        tempres = []
-        obje.append(tempobj)
-        tempobj = []
+    for results, title, indicator, objective in zip(
+            resfile["results"].tolist(), resfile["results_title"].tolist(),
+            resfile["results_indicator"].tolist(), resfile["objectives"].tolist()):
+        resu.append([str(results), str(title), str(indicator)])
+        obje.append([str(objective)])
     return resu, obje
 
 
+def join_files(ombfile, isos, locfile, docfile, resfile):
+    """
+    Attach the documents, results, objectives and sub-national locations to every row of the omb file.
+    Each mapping row is formatted once, and the rows sharing a clean id share the same lists.
+    :param ombfile: The source file to grab the data from
+    :param isos: The recipient code of each row.
+    :param locfile: the location file to use for mapping.
+    :param docfile: the documents file to use for mapping.
+    :param resfile: the results file to use for mapping.
+    :return joined: the (documents, results, objectives, locations) of each omb row
+    """
+    docs = document_rows(docfile)
+    resu, obje = result_rows(resfile)
+    doc_dict, res_dict = dictfiles(docfile, resfile)
+    loc_dict = location_dict(locfile)
+
+    joined = []
+    cleanids = {}
+    empty = ([], [], [], [])
+    for cleanid, country in zip(ombfile["Clean ID"].tolist(), isos):
+        clean_id = str(cleanid)
+        if clean_id == 'nan':
+            joined.append(empty)
+            continue
+        if clean_id not in cleanids:
+            resrows = res_dict.get(clean_id, [])
+            cleanids[clean_id] = ([docs[d] for d in doc_dict.get(clean_id, [])],
+                                  [resu[r] for r in resrows], [obje[r] for r in resrows])
+        joined.append(cleanids[clean_id] + (loc_dict.get((clean_id, country), []),))
+    return joined
+
+
 def lang_loop(transelement, langs, translations):
     """
     Create narratives for each language translation available.
@@ -354,7 +756,7 @@ def lang_loop(transelement, langs, translations):
         if i is 'en':
             langnarrative = SubElement(transelement, 'narrative')
         else:
-            langnarrative = SubElement(transelement, 'narrative', xml__lang=i)
+            langnarrative = SubElement(transelement, 'narrative', {xmllang: i})
         if translations[it] != 'nan':
             langnarrative.text = translations[it]
         else:
@@ -441,9 +843,60 @@ def percentage_loop(reltrans, file):
     return alltotal, regiontotal, sectortotal
 
 
-def open_files():
+def file_signature(filename):
+    """
+    Return the values identifying the current version of an input file.
+    :param filename: The path of the file to check.
+    :return signature: The absolute path, size, modified time and SHA-1 hash of the file.
+    """
+    stats = os.stat(filename)
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as source:
+        for chunk in iter(lambda: source.read(1048576), b''):
+            digest.update(chunk)
+    return [os.path.abspath(filename), stats.st_size, stats.st_mtime, digest.hexdigest()]
+
+
+def read_workbook(filename, columns, reparse=False):
+    """
+    Read the columns of an Excel file, using the cached copy beside it if the file has not changed.
+    The cache holds the file signature followed by the pickled DataFrame, so a stale
+    cache is found without loading the data.
+    :param filename: The path of the Excel file to read.
+    :param columns: The schema of the columns to read and their types.
+    :param reparse: Set to True to ignore the cache and read the Excel file again.
+    :return frame: The DataFrame of the Excel file.
+    """
+    signature = file_signature(filename)
+    # A change to the schema also changes what is in the cache.
+    signature.append(sorted(columns.items()))
+    cachefile = filename + '.cache'
+    if not reparse and os.path.exists(cachefile):
+        try:
+            with open(cachefile, 'rb') as cache:
+                if pickle.load(cache) == signature:
+                    print('Using cached copy of ' + filename)
+                    return pickle.load(cache)
+        except Exception:
+            # A cache written by another pandas version or cut short is rebuilt below.
+            pass
+    dtypes = dict((column, dtype) for column, dtype in columns.items() if dtype is not None)
+    frame = pandas.read_excel(filename, encoding='utf-8', usecols=lambda column: column in columns, dtype=dtypes)
+    try:
+        with open(cachefile + '.tmp', 'wb') as cache:
+            pickle.dump(signature, cache, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(frame, cache, pickle.HIGHEST_PROTOCOL)
+        os.replace(cachefile + '.tmp', cachefile)
+    except OSError:
+        print('Could not write the cache for ' + filename)
+    return frame
+
+
+def open_files(reparse=False, parallel=False):
     """
     Prompts the user for files to run the script on.
+    :param reparse: Set to True to read the Excel files again instead of their caches.
+    :param parallel: Set to True to read all of the files at the same time in separate processes.
     :return omb: The omb file with the main data
     :return loc_file: The location file with the sub-national location mapping data
     :return doc_file: The documents file with the document mapping data
@@ -453,880 +906,1099 @@ def open_files():
     # Prompt user for filename
     # filetoopen = input("What is the name of the omb source file? ")
     filetoopen = 'FY18Q4 Humanitarian/final_iati_data_human.xlsx'
-    print('Opening OMB file...')
-    # Read the file
-    try:
-        ombf = pandas.read_excel(filetoopen, encoding='utf-8')
-    except FileNotFoundError:
-        sys.exit("OMB file does not exist.")
-    # Output the number of rows
-    print('Total rows: {0}'.format(len(ombf)))
-    # See which headers are available
-    print(list(ombf))
-
     # loctoopen = input("What is the name of the location mapping file? ")
     loctoopen = 'FY18Q4 Humanitarian/Subnat mapping.xlsx'
-    print('Opening location file...')
-    # Read the file
-    try:
-        locs_file = pandas.read_excel(loctoopen, encoding='utf-8')
-    except FileNotFoundError:
-        sys.exit("Location file does not exist.")
-    # Output the number of rows
-    print('Total rows: {0}'.format(len(locs_file)))
-    # See which headers are available
-    print(list(locs_file))
-
     # doctoopen = input("What is the name of the document mapping file? ")
     doctoopen = 'FY18Q4 Humanitarian/DEC mapping.xlsx'
-    print('Opening document file...')
-    # Read the file
-    try:
-        docs_file = pandas.read_excel(doctoopen, encoding='utf-8')
-    except FileNotFoundError:
-        sys.exit("Document file does not exist.")
-    # Output the number of rows
-    print('Total rows: {0}'.format(len(docs_file)))
-    # See which headers are available
-    print(list(docs_file))
-
     # histtoopen = input("What is the name of the historical data file? ")
     histtoopen = 'FY18Q4 Humanitarian/historical_transactions.xlsx'
-    print('Opening historical data file...')
-    # Read the file
-    try:
-        hists_file = pandas.read_excel(histtoopen, encoding='utf-8')
-    except FileNotFoundError:
-        sys.exit("Historical file does not exist.")
-    # Output the number of rows
-    print('Total rows: {0}'.format(len(hists_file)))
-    # See which headers are available
-    print(list(hists_file))
-
     # restoopen = input("What is the name of the results data file? ")
     restoopen = 'FY18Q4 Humanitarian/Obj Results mapping.xlsx'
-    print('Opening results data file...')
-    # Read the file
-    try:
-        resu_file = pandas.read_excel(restoopen, encoding='utf-8')
-    except FileNotFoundError:
-        sys.exit("Results file does not exist.")
-    # Output the number of rows
-    print('Total rows: {0}'.format(len(resu_file)))
-    # See which headers are available
-    print(list(resu_file))
+    sources = [(filetoopen, 'OMB file', "OMB file does not exist.", schema['omb']),
+               (loctoopen, 'location file', "Location file does not exist.", schema['location']),
+               (doctoopen, 'document file', "Document file does not exist.", schema['document']),
+               (histtoopen, 'historical data file', "Historical file does not exist.", schema['historical']),
+               (restoopen, 'results data file', "Results file does not exist.", schema['results'])]
 
-    return ombf, locs_file, docs_file, hists_file, resu_file
+    if not parallel:
+        return report_files(sources, reparse=reparse)
+    # Each file is read in its own process, so the slowest file sets the opening time.
+    with concurrent.futures.ProcessPoolExecutor(len(sources)) as pool:
+        loads = [pool.submit(read_workbook, source[0], source[3], reparse) for source in sources]
+        return report_files(sources, loads)
 
 
-curtime = time.time()
-omb, loc_file, doc_file, hist_file, res_file = open_files()
-opentime = time.time() - curtime
-print('Converting format...')
-now = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+def report_files(sources, loads=None, reparse=False):
+    """
+    Read each of the input files in order and print a summary of them.
+    :param sources: The filename, description, missing file message and schema of each input file.
+    :param loads: The pending reads of the files from the process pool, if any.
+    :param reparse: Set to True to read the Excel files again instead of their caches.
+    :return frames: The DataFrames of the files, in the order of the sources.
+    """
+    frames = list()
+    for i in range(0, len(sources)):
+        filename, description, missing, columns = sources[i]
+        print('Opening ' + description + '...')
+        # Read the file
+        try:
+            if loads:
+                frame = loads[i].result()
+            else:
+                frame = read_workbook(filename, columns, reparse)
+        except FileNotFoundError:
+            sys.exit(missing)
+        except ValueError as error:
+            sys.exit('The ' + description + ' has a value that does not match the schema: ' + str(error))
+        # Stop before converting anything if a column the script needs is not in the file
+        absent = [column for column in columns if column not in frame]
+        if absent:
+            sys.exit('The ' + description + ' is missing the columns: ' + ', '.join(absent))
+        # Output the number of rows
+        print('Total rows: {0}'.format(len(frame)))
+        # See which headers are available
+        print(list(frame))
+        frames.append(frame)
+    return frames
+
+
+def output_name(ombActs):
+    """
+    Return the name of the file to write a group of activities to, in today's export folder.
+    :param ombActs: The group of activities.
+    :return filename: The name of the file.
+    """
+    # This is to write to a singular file.
+    # return 'iati-activities-full.xml'
 
-# Variable creation
-idlist, idawards, isolist = id_loop(omb)
-locdict, docdict, histdict, resdict = dictfiles(loc_file, doc_file, hist_file, res_file)
-# This will turn on full dataset dump into one XML. Untab all code after this.
-ombActs = activities_loop(idlist)
+    # This line is for country names
+    # TODO: int(ombActs[1]) <-> int(act)
+    return 'export/' + time.strftime("%m-%d-%Y") + '/iati-activities-Humanitarian.xml'
+    # return 'export/' + time.strftime("%m-%d-%Y") + '/iati-activities-' + \
+    #     str(omb["Country File Name"][int(ombActs[1])]) + '.xml'
+    # This line is for country codes
+    # return 'export/' + time.strftime("%m-%d-%Y") + '/iati-activities-' + ombActs[0] + '.xml'
 
-h1acts = activities_loop(idlist)
 
-# This will turn on the splitting of the file via recipient if you uncomment this and tab everything after these.
-# ombgrouping = group_split(omb)
-# for ombActs in ombgrouping:
+def group_digest(ombActs, tables, script):
+    """
+    Make a hash of everything the file of a group is built from, to tell whether it has changed since the last run.
+    It covers the omb rows of the group's activities and of their related activities and transactions, the documents,
+    results, objectives and locations joined to them, their historical transactions, which of their dates have passed
+    and the script itself. The run date is left out, so an unchanged file can be kept from an earlier run.
+    :param ombActs: The rows of the group.
+    :param tables: The tables the main run made from the input files.
+    :param script: The SHA-1 hash of the script.
+    :return digest: The hex SHA-1 hash of the group.
+    """
+    rows, joined, histdict = tables['rows'], tables['joined'], tables['histdict']
+    idlist, idawards, isolist = tables['idlist'], tables['idawards'], tables['isolist']
+    h1acts, relateddict, transdict = tables['h1acts'], tables['relateddict'], tables['transdict']
+    now = tables['now']
+
+    digest = script.copy()
+    # The same rows as build_activities reads
+    for act in list(ombActs):
+        if act in h1acts:
+            digest.update(repr((rows[act], idlist[act])).encode('utf-8'))
+            for relact in relateddict[idlist[act]]:
+                row = rows[relact]
+                award = idawards[relact]
+                digest.update(repr((row, isolist[relact], award, joined[relact],
+                                    histdict.get((str(row.Implementing_Mechanism_ID), isolist[relact]), []),
+                                    row.start_date_iso <= now, row.end_date_iso <= now,
+                                    [rows[trans] for trans in transdict[award]])).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def save_manifest(manifest):
+    """
+    Write the manifest of the files in the export folder, replacing the last one whole.
+    :param manifest: The hash and path of each file, by file name.
+    :return: N/A
+    """
+    try:
+        with open(manifest_file + '.tmp', 'wb') as output:
+            pickle.dump(manifest, output, pickle.HIGHEST_PROTOCOL)
+        os.replace(manifest_file + '.tmp', manifest_file)
+    except OSError:
+        print('Could not write the manifest ' + manifest_file)
 
-filesleft = len(ombActs)
 
-ver = '2.03'
-fasite = 'https://explorer.usaid.gov/'
+def plan_groups(ombgrouping, tables, rebuild=False):
+    """
+    Work out which groups need their files built, from the manifest of the last runs.
+    A group whose hash matches the manifest has the file the last run wrote for it copied into today's folder instead.
+    A group whose file a later group writes over is left out, since only the last one is kept.
+    :param ombgrouping: The groups of rows, one for each file.
+    :param tables: The tables the main run made from the input files.
+    :param rebuild: Set to True to build every group again.
+    :return build, manifest: The groups to build, and the manifest to save once they are written.
+    """
+    with open(__file__, 'rb') as source:
+        script = hashlib.sha1(source.read())
+    manifest = {}
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file, 'rb') as saved:
+                manifest = pickle.load(saved)
+        except Exception:
+            # A manifest cut short means every file is built again.
+            pass
 
-activities = Element('iati-activities', version=ver,
-                     generated_h_datetime=date, xmlns__usg=fasite)
+    last = collections.OrderedDict()
+    for ombActs in ombgrouping:
+        last[output_name(ombActs)] = ombActs
+    build = []
+    digests = {}
+    for filename, ombActs in last.items():
+        name = os.path.basename(filename)
+        digest = group_digest(ombActs, tables, script)
+        if not rebuild and name in manifest and manifest[name][0] == digest and os.path.exists(manifest[name][1]):
+            if os.path.abspath(manifest[name][1]) != os.path.abspath(filename):
+                shutil.copyfile(manifest[name][1], filename)
+            manifest[name] = (digest, filename)
+            print('Unchanged since the last run: ' + name)
+        else:
+            # Until the new file is written, it must not be taken for the last run's one
+            manifest.pop(name, None)
+            digests[name] = (digest, filename)
+            build.append(ombActs)
+    save_manifest(manifest)
+    manifest.update(digests)
+    return build, manifest
 
-# Start creating the hierarchy 1 groupings
-c = 2
-# For loop for the amount of activities
-for act in ombActs:
-    if c > 1:
-        if act in h1acts:
-            # Variables
-            hier = '1'
-            lastUpdate = date
-            # TODO: Presumably, pull in data from alternate translation fields?
-            langList = ['en']
-            cur = 'USD'
-            ident = idlist[act]
-            repOrgRef = 'US-GOV-1'
-            repOrgType = '10'  # Government
-            repOrgText = 'U.S. Agency for International Development'
-            partOrgText1 = str(omb["Appropriated Agency"][act])
-            partOrgRef1 = orgnumber(partOrgText1)
-            partOrgRole1 = '1'
-            partOrgType1 = '10'  # Government
-            partOrgRef2 = 'US-GOV-1'  # USAID
-            partOrgRole2 = '2'
-            partOrgText2 = 'U.S. Agency for International Development'
-            partOrgType2 = '10'  # Government
-            titleText = list()
-            descText = list()
-
-            # Create the activity group's name
-            if str(omb["DAC Country Name"][act]) != 'nan':
-                try:
-                    name = str(omb["DAC Country Name"][act])
-                    if name == "CÃ´te dâ€™Ivoire":
-                        name = "Côte d'Ivoire"
-                    elif name == "Lao Peopleâ€™s Democratic Republic":
-                        name = "Lao People's Democratic Republic"
-                    title = 'US-' + name + '-' + partOrgText2
-                except ValueError:
-                    name = str(omb["DAC Country Name"][act])
-                    if name == "CÃ´te dâ€™Ivoire":
-                        name = "Côte d'Ivoire"
-                    elif name == "Lao Peopleâ€™s Democratic Republic":
-                        name = "Lao People's Democratic Republic"
-                    title = 'US-' + name + '-' + partOrgText2
-            else:
-                title = 'US-Worldwide-' + partOrgText2
-            titleText.append(title)
-            titleText.append('')
-            descText.append(str(omb["Implementing Mechanism Purpose Statement"][act]))
-            descText.append('')
-
-            relatedList = related_loop(idlist, idawards, ident)
-
-            for rel in relatedList:
-                relType = '2'
-                relRef = idawards[rel]
-
-            # Begin creating the activities
-            for relact in relatedList:
-                clean_id = str(omb["Clean ID"][relact])
-                clean_ou = str(omb["Clean OU Name"][relact])
-                award_id = str(omb["Implementing Mechanism ID"][relact])
+
+def build_activities(ombActs, tables, c=2):
+    """
+    Build the activities for a group of rows, handing each one back as soon as it is finished.
+    :param ombActs: The rows to build the activities of.
+    :param tables: The tables the main run made from the input files.
+    :param c: The count of the first row. Rows are only built from 2 on, which skips the recipient code of a group.
+    :return activity: Each finished iati-activity element, one at a time.
+    """
+    rows = tables['rows']
+    idlist, idawards, isolist = tables['idlist'], tables['idawards'], tables['isolist']
+    h1acts, relateddict, transdict = tables['h1acts'], tables['relateddict'], tables['transdict']
+    histdict, joined = tables['histdict'], tables['joined']
+    date, now = tables['date'], tables['now']
+
+    # Start creating the hierarchy 1 groupings
+    # For loop for the amount of activities
+    for act in ombActs:
+        if c > 1:
+            if act in h1acts:
+                actrow = rows[act]
+                # Variables
                 hier = '1'
                 lastUpdate = date
+                # TODO: Presumably, pull in data from alternate translation fields?
                 langList = ['en']
                 cur = 'USD'
-                countryinit = isolist[relact]
-                identity = idawards[relact]
+                ident = idlist[act]
                 repOrgRef = 'US-GOV-1'
                 repOrgType = '10'  # Government
                 repOrgText = 'U.S. Agency for International Development'
-                # These will need to be looped through and placed into narratives.
+                partOrgText1 = str(actrow.Appropriated_Agency)
+                partOrgRef1 = orgnumber(partOrgText1)
+                partOrgRole1 = '1'
+                partOrgType1 = '10'  # Government
+                partOrgRef2 = 'US-GOV-1'  # USAID
+                partOrgRole2 = '2'
+                partOrgText2 = 'U.S. Agency for International Development'
+                partOrgType2 = '10'  # Government
                 titleText = list()
                 descText = list()
-                titleText.append(str(omb["Implementing Mechanism Title"][relact]))
+
+                # Create the activity group's name
+                if str(actrow.DAC_Country_Name) != 'nan':
+                    try:
+                        name = str(actrow.DAC_Country_Name)
+                        if name == "CÃ´te dâ€™Ivoire":
+                            name = "Côte d'Ivoire"
+                        elif name == "Lao Peopleâ€™s Democratic Republic":
+                            name = "Lao People's Democratic Republic"
+                        title = 'US-' + name + '-' + partOrgText2
+                    except ValueError:
+                        name = str(actrow.DAC_Country_Name)
+                        if name == "CÃ´te dâ€™Ivoire":
+                            name = "Côte d'Ivoire"
+                        elif name == "Lao Peopleâ€™s Democratic Republic":
+                            name = "Lao People's Democratic Republic"
+                        title = 'US-' + name + '-' + partOrgText2
+                else:
+                    title = 'US-Worldwide-' + partOrgText2
+                titleText.append(title)
                 titleText.append('')
-                descText.append(str(omb["Implementing Mechanism Purpose Statement"][relact]))
+                descText.append(str(actrow.Implementing_Mechanism_Purpose_Statement))
                 descText.append('')
-                partOrgText = str(omb["Appropriated Agency"][relact])
-                partOrgRef = orgnumber(partOrgText)
-                partOrgRole = '1'
-                partOrgRef2 = 'US-GOV-1'
-                partOrgRole2 = '2'
-                partOrgText2 = 'U.S. Agency for International Development'
-                partOrgType2 = '10'
-                partOrgRole3 = '3'
-                partOrgText3 = 'U.S. Agency for International Development'
-                # These may change, depending on input.
-                # TODO: If more organizations become used, they will need impl.
-                partOrgRef3 = orgnumber(partOrgText3)
-                partOrgType3 = '10'
-                partOrgRole4 = '4'
-                partOrgText4 = str(omb["Implementing Agent"][relact])
-                if str(omb["IATI Organization ID"][relact]) == 'nan':
-                    partOrgRef4 = orgnumber(partOrgText4)
-                else:
-                    partOrgRef4 = str(omb["IATI Organization ID"][relact])
 
-                try:
-                    partOrgType4 = str(int(omb["Implementing Agent Type"][relact]))
-                except ValueError:
-                    partOrgType4 = ''
-                try:
-                    activityStatusCode = str(int(omb["Reporting Status"][relact]))
-                except ValueError:
-                    activityStatusCode = '1'
+                relatedList = relateddict[ident]
+
+                for rel in relatedList:
+                    relType = '2'
+                    relRef = idawards[rel]
+
+                # Begin creating the activities
+                for relact in relatedList:
+                    row = rows[relact]
+                    clean_id = str(row.Clean_ID)
+                    clean_ou = str(row.Clean_OU_Name)
+                    award_id = str(row.Implementing_Mechanism_ID)
+                    hier = '1'
+                    lastUpdate = date
+                    langList = ['en']
+                    cur = 'USD'
+                    countryinit = isolist[relact]
+                    identity = idawards[relact]
+                    repOrgRef = 'US-GOV-1'
+                    repOrgType = '10'  # Government
+                    repOrgText = 'U.S. Agency for International Development'
+                    # These will need to be looped through and placed into narratives.
+                    titleText = list()
+                    descText = list()
+                    titleText.append(str(row.Implementing_Mechanism_Title))
+                    titleText.append('')
+                    descText.append(str(row.Implementing_Mechanism_Purpose_Statement))
+                    descText.append('')
+                    partOrgText = str(row.Appropriated_Agency)
+                    partOrgRef = orgnumber(partOrgText)
+                    partOrgRole = '1'
+                    partOrgRef2 = 'US-GOV-1'
+                    partOrgRole2 = '2'
+                    partOrgText2 = 'U.S. Agency for International Development'
+                    partOrgType2 = '10'
+                    partOrgRole3 = '3'
+                    partOrgText3 = 'U.S. Agency for International Development'
+                    # These may change, depending on input.
+                    # TODO: If more organizations become used, they will need impl.
+                    partOrgRef3 = orgnumber(partOrgText3)
+                    partOrgType3 = '10'
+                    partOrgRole4 = '4'
+                    partOrgText4 = str(row.Implementing_Agent)
+                    if str(row.IATI_Organization_ID) == 'nan':
+                        partOrgRef4 = orgnumber(partOrgText4)
+                    else:
+                        partOrgRef4 = str(row.IATI_Organization_ID)
 
-                # All dates are always "actual". There are no "planned" dates.
-                try:
-                    isodatetime = str(int(omb["Start Date"][relact]))
-                    isodatetimeformatstart = isodatetime[0:4] + '-' +\
-                        isodatetime[4:6] + '-' + isodatetime[6:8]
-                    activityStartDateText = ''
-                except ValueError:
-                    isodatetimeformatstart = str(int(datetime.datetime.utcnow().strftime('%Y'))-1) + '-10-01'
-                    activityStartDateText = str(omb["start_date_narr"][relact])
-                try:
-                    isodatetime = str(int(omb["End Date"][relact]))
-                    isodatetimeformatend = isodatetime[0:4] + '-' + isodatetime[4:6] +\
-                        '-' + isodatetime[6:8]
-                    activityEndDateText = ''
-                except ValueError:
-                    isodatetimeformatend = datetime.datetime.utcnow().strftime('%Y') + '-10-01'
-                    activityEndDateText = str(omb["end_date_narr"][relact])
-                activityDateTypePlanStart = '1'
-                activityDateTypeStart = '2'
-                activityDateTypePlanEnd = '3'
-                activityDateTypeEnd = '4'
-                activityScopeCode = str(int(omb["Activity Scope"][relact]))
-                try:
-                    signdate = \
-                        str(int(omb["Implementing Mechanism Signing Date"][relact]))
-                    signdateformat = signdate[0:4] + '-' + signdate[4:6] + '-' +\
-                        signdate[6:8]
-                except ValueError:
-                    signdateformat = str(int(datetime.datetime.utcnow().strftime('%Y'))-1) + '-10-01'
-
-                # Put together the first part of the activity element tree
-                activity = SubElement(activities, 'iati-activity', hierarchy=hier,
-                                      last_h_updated_h_datetime=lastUpdate,
-                                      xml__lang=langList[0], default_h_currency=cur)
-                identifier = SubElement(activity, 'iati-identifier')
-                repId = repOrgRef + '-' + countryinit + '-' + award_id
-                identifier.text = repId
-                reporting_org = SubElement(activity, 'reporting-org', ref=repOrgRef,
-                                           type=repOrgType)
-                narrative = SubElement(reporting_org, 'narrative')
-                narrative.text = repOrgText
-                title = SubElement(activity, 'title')
-                lang_loop(title, langList, titleText)
-                description = SubElement(activity, 'description')
-                lang_loop(description, langList, descText)
-
-                # Populate the results and objectives
-                resList = []
-                objList = []
-                if clean_id != 'nan':
-                    if clean_id in resdict:
-                        resList, objList = results_loop(res_file, clean_id, resdict)
-
-                    for obj in objList:
-                        if obj[0] != 'nan' and obj[0] != '':
-                            transObjective = SubElement(activity, 'description', type='2')
-                            narrative = SubElement(transObjective, 'narrative')
-                            narrative.text = obj[0]
-
-                participating_org1 = SubElement(activity, 'participating-org',
-                                                ref=partOrgRef, role=partOrgRole, type=partOrgType1)
-                narrative = SubElement(participating_org1, 'narrative')
-                narrative.text = partOrgText1
-                participating_org2 = SubElement(activity, 'participating-org',
-                                                ref=partOrgRef2, role=partOrgRole2, type=partOrgType2)
-                narrative = SubElement(participating_org2, 'narrative')
-                narrative.text = partOrgText2
-                participating_org3 = SubElement(activity, 'participating-org',
-                                                ref=partOrgRef3, role=partOrgRole3, type=partOrgType3)
-                narrative = SubElement(participating_org3, 'narrative')
-                narrative.text = partOrgText3
-                if partOrgRef4 != '':
-                    if partOrgType4 != 'nan':
-                        participating_org4 = SubElement(activity, 'participating-org',
-                                                        ref=partOrgRef4, role=partOrgRole4, type=partOrgType4)
+                    try:
+                        partOrgType4 = str(int(row.Implementing_Agent_Type))
+                    except ValueError:
+                        partOrgType4 = ''
+                    try:
+                        activityStatusCode = str(int(row.Reporting_Status))
+                    except ValueError:
+                        activityStatusCode = '1'
+
+                    # All dates are always "actual". There are no "planned" dates.
+                    isodatetimeformatstart = row.start_date_iso
+                    activityStartDateText = row.start_date_text
+                    isodatetimeformatend = row.end_date_iso
+                    activityEndDateText = row.end_date_text
+                    activityDateTypePlanStart = '1'
+                    activityDateTypeStart = '2'
+                    activityDateTypePlanEnd = '3'
+                    activityDateTypeEnd = '4'
+                    activityScopeCode = str(int(row.Activity_Scope))
+                    signdateformat = row.signing_date_iso
+
+                    # Put together the first part of the activity element tree
+                    activity = Element('iati-activity', {'hierarchy': hier, 'last-updated-datetime': lastUpdate,
+                                                         xmllang: langList[0], 'default-currency': cur})
+                    identifier = SubElement(activity, 'iati-identifier')
+                    repId = repOrgRef + '-' + countryinit + '-' + award_id
+                    identifier.text = repId
+                    activity.append(constant('reporting-org', {'ref': repOrgRef, 'type': repOrgType}, repOrgText))
+                    title = SubElement(activity, 'title')
+                    lang_loop(title, langList, titleText)
+                    description = SubElement(activity, 'description')
+                    lang_loop(description, langList, descText)
+
+                    # Populate the results, objectives, locations and documents
+                    docsList, resList, objList, locsList = joined[relact]
+                    if clean_id != 'nan':
+                        for obj in objList:
+                            if obj[0] != 'nan' and obj[0] != '':
+                                transObjective = SubElement(activity, 'description', type='2')
+                                narrative = SubElement(transObjective, 'narrative')
+                                narrative.text = obj[0]
+
+                    participating_org1 = SubElement(activity, 'participating-org',
+                                                    ref=partOrgRef, role=partOrgRole, type=partOrgType1)
+                    narrative = SubElement(participating_org1, 'narrative')
+                    narrative.text = partOrgText1
+                    activity.append(constant('participating-org',
+                                             {'ref': partOrgRef2, 'role': partOrgRole2, 'type': partOrgType2},
+                                             partOrgText2))
+                    activity.append(constant('participating-org',
+                                             {'ref': partOrgRef3, 'role': partOrgRole3, 'type': partOrgType3},
+                                             partOrgText3))
+                    if partOrgRef4 != '':
+                        if partOrgType4 != 'nan':
+                            participating_org4 = SubElement(activity, 'participating-org',
+                                                            ref=partOrgRef4, role=partOrgRole4, type=partOrgType4)
+                        else:
+                            participating_org4 = SubElement(activity, 'participating-org',
+                                                            ref=partOrgRef4, role=partOrgRole4)
                     else:
-                        participating_org4 = SubElement(activity, 'participating-org',
-                                                        ref=partOrgRef4, role=partOrgRole4)
-                else:
-                    if partOrgType4 != 'nan':
-                        participating_org4 = SubElement(activity, 'participating-org',
-                                                        role=partOrgRole4, type=partOrgType4)
+                        if partOrgType4 != 'nan':
+                            participating_org4 = SubElement(activity, 'participating-org',
+                                                            role=partOrgRole4, type=partOrgType4)
+                        else:
+                            participating_org4 = SubElement(activity, 'participating-org',
+                                                            role=partOrgRole4)
+
+                    narrative = SubElement(participating_org4, 'narrative')
+                    if partOrgText4 != 'nan':
+                        narrative.text = partOrgText4
                     else:
-                        participating_org4 = SubElement(activity, 'participating-org',
-                                                        role=partOrgRole4)
-
-                narrative = SubElement(participating_org4, 'narrative')
-                if partOrgText4 != 'nan':
-                    narrative.text = partOrgText4
-                else:
-                    narrative.text = '--'
-
-                activity_status = SubElement(activity, 'activity-status',
-                                             code=activityStatusCode)
-
-                # All dates are always "actual". There are no "planned" dates.
-                # activity_planstart = SubElement(activity, 'activity-date',
-                #                            iso_h_date=isodatetimeformatstart,
-                #                            type=activityDateTypePlanStart)
-                activity_planstartdate = SubElement(activity, 'activity-date',
-                                                    iso_h_date=isodatetimeformatstart,
-                                                    type=activityDateTypePlanStart)
-
-                if isodatetimeformatstart <= now:
-                    activity_startdate = SubElement(activity, 'activity-date',
-                                                    iso_h_date=isodatetimeformatstart, type=activityDateTypeStart)
-                if activityStartDateText:
-                    narrative = SubElement(activity_planstartdate, 'narrative')
-                    narrative.text = activityStartDateText
-
-                # All dates are always "actual". There are no "planned" dates.
-                # activity_planend = SubElement(activity, 'activity-date',
-                #                               iso_h_date=isodatetimeformatend,
-                #                               type=activityDateTypePlanEnd)
-                activity_planenddate = SubElement(activity, 'activity-date',
-                                                  iso_h_date=isodatetimeformatend, type=activityDateTypePlanEnd)
-                if isodatetimeformatend <= now:
-                    activity_enddate = SubElement(activity, 'activity-date',
-                                                  iso_h_date=isodatetimeformatend, type=activityDateTypeEnd)
-                if activityEndDateText:
-                    narrative = SubElement(activity_planenddate, 'narrative')
-                    narrative.text = activityEndDateText
-
-                # Contact information block variables
-                contactType = '1'
-                organisationText = 'U.S. Agency for International Development'
-                personNameText = str(omb["USAID contact name"][relact])
-                telephoneText = str(omb["USAID contact telephone"][relact])
-                emailText = str(omb["USAID contact email"][relact])
-                websiteText = str(omb["Activity Website"][relact])
-                mailingText = str(omb["USAID contact address"][relact])
-
-                # Contact information block
-                contact_info = SubElement(activity, 'contact-info', type=contactType)
-                organisation = SubElement(contact_info, 'organisation')
-                narrative = SubElement(organisation, 'narrative')
-                narrative.text = organisationText
-                person_name = SubElement(contact_info, 'person-name')
-                narrative = SubElement(person_name, 'narrative')
-                if personNameText != 'nan':
-                    narrative.text = personNameText
-                telephone = SubElement(contact_info, 'telephone')
-                if telephoneText != 'nan':
-                    telephone.text = telephoneText
-                email = SubElement(contact_info, 'email')
-                if emailText != 'nan':
-                    email.text = emailText
-                website = SubElement(contact_info, 'website')
-                if websiteText != 'nan':
-                    website.text = websiteText
-                mailing_address = SubElement(contact_info, 'mailing-address')
-                narrative = SubElement(mailing_address, 'narrative')
-                if mailingText != 'nan':
-                    narrative.text = mailingText
-
-                activity_scope = SubElement(activity, 'activity-scope',
-                                            code=activityScopeCode)
-
-                # Variables
-                recipientCountryPercentage = '100'  # This will never not be 100%
-
-                # Pre-transaction information block
-                if str(omb["ISO Alpha Code"][relact]) == 'nan':
-                    recipientRegionCode = countryinit
-                    recipient_region = SubElement(activity, 'recipient-region',
-                                                  percentage=recipientCountryPercentage,
-                                                  code=recipientRegionCode)
-                else:
-                    recipientCountryCode = countryinit
-                    recipient_country = SubElement(activity, 'recipient-country',
-                                                   percentage=recipientCountryPercentage,
-                                                   code=recipientCountryCode)
-
-                # Populate the subnational locations
-                if clean_id != 'nan':
-                    if clean_id in locdict:
-                        locsList = location_loop(loc_file, clean_id, countryinit, locdict)
+                        narrative.text = '--'
+
+                    activity_status = SubElement(activity, 'activity-status',
+                                                 code=activityStatusCode)
+
+                    # All dates are always "actual". There are no "planned" dates.
+                    # activity_planstart = SubElement(activity, 'activity-date',
+                    #                            {'iso-date': isodatetimeformatstart,
+                    #                             'type': activityDateTypePlanStart})
+                    activity_planstartdate = SubElement(activity, 'activity-date',
+                                                        {'iso-date': isodatetimeformatstart,
+                                                         'type': activityDateTypePlanStart})
+
+                    if isodatetimeformatstart <= now:
+                        activity_startdate = SubElement(activity, 'activity-date',
+                                                        {'iso-date': isodatetimeformatstart,
+                                                         'type': activityDateTypeStart})
+                    if activityStartDateText:
+                        narrative = SubElement(activity_planstartdate, 'narrative')
+                        narrative.text = activityStartDateText
+
+                    # All dates are always "actual". There are no "planned" dates.
+                    # activity_planend = SubElement(activity, 'activity-date',
+                    #                               {'iso-date': isodatetimeformatend,
+                    #                                'type': activityDateTypePlanEnd})
+                    activity_planenddate = SubElement(activity, 'activity-date',
+                                                      {'iso-date': isodatetimeformatend,
+                                                       'type': activityDateTypePlanEnd})
+                    if isodatetimeformatend <= now:
+                        activity_enddate = SubElement(activity, 'activity-date',
+                                                      {'iso-date': isodatetimeformatend,
+                                                       'type': activityDateTypeEnd})
+                    if activityEndDateText:
+                        narrative = SubElement(activity_planenddate, 'narrative')
+                        narrative.text = activityEndDateText
+
+                    # Contact information block variables
+                    contactType = '1'
+                    organisationText = 'U.S. Agency for International Development'
+                    personNameText = str(row.USAID_contact_name)
+                    telephoneText = str(row.USAID_contact_telephone)
+                    emailText = str(row.USAID_contact_email)
+                    websiteText = str(row.Activity_Website)
+                    mailingText = str(row.USAID_contact_address)
+
+                    # Contact information block
+                    contact_info = SubElement(activity, 'contact-info', type=contactType)
+                    contact_info.append(constant('organisation', {}, organisationText))
+                    person_name = SubElement(contact_info, 'person-name')
+                    narrative = SubElement(person_name, 'narrative')
+                    if personNameText != 'nan':
+                        narrative.text = personNameText
+                    telephone = SubElement(contact_info, 'telephone')
+                    if telephoneText != 'nan':
+                        telephone.text = telephoneText
+                    email = SubElement(contact_info, 'email')
+                    if emailText != 'nan':
+                        email.text = emailText
+                    website = SubElement(contact_info, 'website')
+                    if websiteText != 'nan':
+                        website.text = websiteText
+                    mailing_address = SubElement(contact_info, 'mailing-address')
+                    narrative = SubElement(mailing_address, 'narrative')
+                    if mailingText != 'nan':
+                        narrative.text = mailingText
+
+                    activity_scope = SubElement(activity, 'activity-scope',
+                                                code=activityScopeCode)
+
+                    # Variables
+                    recipientCountryPercentage = '100'  # This will never not be 100%
+
+                    # Pre-transaction information block
+                    if str(row.ISO_Alpha_Code) == 'nan':
+                        recipientRegionCode = countryinit
+                        recipient_region = SubElement(activity, 'recipient-region',
+                                                      percentage=recipientCountryPercentage,
+                                                      code=recipientRegionCode)
                     else:
-                        locsList = []
-                    gis = "http://www.opengis.net/def/crs/EPSG/0/4326"
-                    for loc in locsList:
-                        # FIX: url and format get flipped somehow?
-                        location = SubElement(activity, 'location')
-                        reach = SubElement(location, 'location-reach', code=loc[2])
-                        name = SubElement(location, 'name')
-                        narrative = SubElement(name, 'narrative')
-                        narrative.text = loc[0]
-                        point = SubElement(location, 'point', srsName=gis)
-                        pos = SubElement(point, 'pos')
-                        pos.text = loc[1]
-                        exactness = SubElement(location, 'exactness', code=loc[3])
-                        locationclass = SubElement(location, 'location-class', code=loc[4])
+                        recipientCountryCode = countryinit
+                        recipient_country = SubElement(activity, 'recipient-country',
+                                                       percentage=recipientCountryPercentage,
+                                                       code=recipientCountryCode)
+
+                    # Populate the subnational locations
+                    if clean_id != 'nan':
+                        gis = "http://www.opengis.net/def/crs/EPSG/0/4326"
+                        for loc in locsList:
+                            # FIX: url and format get flipped somehow?
+                            location = SubElement(activity, 'location')
+                            reach = SubElement(location, 'location-reach', code=loc[2])
+                            name = SubElement(location, 'name')
+                            narrative = SubElement(name, 'narrative')
+                            narrative.text = loc[0]
+                            point = SubElement(location, 'point', srsName=gis)
+                            pos = SubElement(point, 'pos')
+                            pos.text = loc[1]
+                            exactness = SubElement(location, 'exactness', code=loc[3])
+                            locationclass = SubElement(location, 'location-class', code=loc[4])
 
-                try:
-                    collabCode = str(int(omb["Collaboration Type Code"][relact]))
-                except ValueError:
-                    if str(omb["Collaboration Type"][relact]) == 'Bilateral':
-                        collabCode = '1'
-                    else:
-                        collabCode = '2'
-                # collabCode = str(int(omb["Collaboration Type Code"][relact]))
-                try:
-                    flowType = str(int(omb["Flow Type"][relact]))
-                except ValueError:
-                    flowType = '0'
-                try:
-                    financeType = str(int(omb["Finance Type"][relact]))
-                except ValueError:
-                    financeType = '0'
-                try:
-                    aidType = str(omb["Aid Type Code"][relact])
-                except ValueError:
-                    aidType = '0'
-                try:
-                    tiedCode = str(int(omb["Tying Status of Award"][relact]))
-                except ValueError:
-                    tiedCode = '0'
-                # This is for error checking
-                periodStartDate = ''
-                try:
-                    if str(int(omb["Start Date"][relact])) != 'nan':
-                        periodStart = \
-                            str(int(omb["Start Date"][relact]))
-                        periodStartDate = periodStart[0:4] + '-' + periodStart[4:6] + '-' + periodStart[6:8]
-                except ValueError:
-                    periodStartDate = str(int(omb["Beginning Fiscal Funding Year"][relact])) + '-10-01'
-                periodEndDate = ''
-                try:
-                    if str(int(omb["End Date"][relact])) != 'nan':
-                        periodEnd = \
-                            str(int(omb["End Date"][relact]))
-                        periodEndDate = periodEnd[0:4] + '-' + periodEnd[4:6] + '-' + periodEnd[6:8]
-                except ValueError:
                     try:
-                        if str(int(omb["Ending Fiscal Funding Year"][relact])) != 'nan':
-                            periodEndDate = str(int(omb["Ending Fiscal Funding Year"][relact])) + '-09-30'
+                        collabCode = str(int(row.Collaboration_Type_Code))
                     except ValueError:
-                        periodEndDate = ''
-                budgetValueDate = periodStartDate
-                try:
-                    totalallocationsfloat = float(omb["Total allocations"][relact])
-                    budgetAmount = str('{0:.2f}'.format(omb["Total allocations"][relact]))
-                    if budgetAmount == 'nan':
-                        budgetAmount = '0.00'
-                except ValueError:
-                    budgetAmount = '0.00'
-                budgetStatus = "1"
-
-                # Create the pre-transaction types element tree
-                collaboration_type = SubElement(activity, 'collaboration-type',
-                                                code=collabCode)
-                if flowType != '0':
-                    default_flow_type = SubElement(activity, 'default-flow-type',
-                                                   code=flowType)
-                if financeType != '0':
-                    default_finance_type = SubElement(activity, 'default-finance-type',
-                                                      code=financeType)
-                if aidType != '0':
-                    default_aid_type = SubElement(activity, 'default-aid-type',
-                                                  code=aidType)
-                if tiedCode != '0':
-                    default_tied_status = SubElement(activity, 'default-tied-status',
-                                                     code=tiedCode)
-
-                # Budget block
-                if budgetAmount != '0.00':
-                    budget = SubElement(activity, 'budget', status=budgetStatus)
-                    SubElement(budget, 'period-start', iso_h_date=periodStartDate)
-                    SubElement(budget, 'period-end', iso_h_date=periodEndDate)
-                    budgetValue = SubElement(budget, 'value', currency=cur,
-                                             value_h_date=budgetValueDate)
-                    budgetValue.text = budgetAmount
-
-                # Create the list of transactions for a specific activity
-                # histList = trans_loop(histdict, idawards[relact])
-                histList = historical_loop(histdict, award_id, countryinit, hist_file)
-                transList = trans_loop(idawards, idawards[relact])
-
-                # These two make it easier to determine
-                # if a 0 has been put in for com/dis
-                # If changed to True, then a 0 transaction will not be put into XML
-                comMarker = True
-                disMarker = True
-
-                # Loop through the historical transactions
-                for trans in histList:
-
-                    transaction = ''
-                    valueAmount = trans[1]
-                    transType = trans[0]
-                    if transType == "Commitment" or transType == "Obligation":
-                        transaction_code = '2'
-                    elif transType == "Disbursement":
-                        transaction_code = '3'
-                    else:
-                        transaction_code = '0'
-                    value_datetime = trans[2]
-                    # Make sure there is exactly 1 transaction value of 0.00 for Com if needed
-                    if transaction_code == '2':
-                        if (comMarker is True and valueAmount != '0.00')\
-                                or (comMarker is False and valueAmount == '0.00'):
-                            # Set the elements
-                            transaction = SubElement(activity, 'transaction')
-                            transaction_type = SubElement(transaction, 'transaction-type',
-                                                          code=transaction_code)
-                            transaction_date = SubElement(transaction, 'transaction-date',
-                                                          iso_h_date=value_datetime)
-                            value = SubElement(transaction, 'value',
-                                               value_h_date=value_datetime)
-                            value.text = valueAmount
-
-                        if str(int(trans[3])) != '0':
-                            sector = SubElement(transaction, 'sector',
-                                                code=str(int(trans[3])), vocabulary='1')
-                        # Cluster Codes
-                        # TODO: adjust the cluster code column name
-                        try:
-                            clusters = ""
-                            # clusters = str(omb["cluster_codes"][trans])
-                        except ValueError:
-                            clusters = ""
-
-                        if clusters != "" and clusters != "nan":
-                            cluster_loop(clusters, transaction)
-
-                    # Make sure there is exactly 1 transaction value of 0.00 for Disb if needed
-                    if transaction_code == '3':
-                        if (disMarker is True and valueAmount != 0) or (
-                                disMarker is False and valueAmount == 0):
-                            # Set the elements
-                            transaction = SubElement(activity, 'transaction')
-                            transaction_type = SubElement(transaction, 'transaction-type',
-                                                          code=transaction_code)
-                            transaction_date = SubElement(transaction, 'transaction-date',
-                                                          iso_h_date=value_datetime)
-                            value = SubElement(transaction, 'value',
-                                               value_h_date=value_datetime)
-                            value.text = valueAmount
-
-                        # DAC Sectors
-                        if str(int(trans[3])) != '0':
-                            sector = SubElement(transaction, 'sector',
-                                                code=str(int(trans[3])), vocabulary='1')
-                        # Cluster Codes
-                        # TODO: adjust the cluster code column name
-                        try:
-                            clusters = ""
-                            # clusters = str(omb["cluster_codes"][trans])
-                        except ValueError:
-                            clusters = ""
-
-                        if clusters != "" and clusters != "nan":
-                            cluster_loop(clusters, transaction)
-
-                # Loop through the transactions related to the activity
-                for trans in transList:
-                    # Variables that depend on entries
-                    # If the disbursement has a value, set value to disbursement.
+                        if str(row.Collaboration_Type) == 'Bilateral':
+                            collabCode = '1'
+                        else:
+                            collabCode = '2'
+                    # collabCode = str(int(omb["Collaboration Type Code"][relact]))
                     try:
-                        transAmount = float(omb["Award Transaction Value"][trans])
-                        valueAmount = str('{0:.2f}'.format(transAmount))
+                        flowType = str(int(row.Flow_Type))
                     except ValueError:
-                        valueAmount = '0.00'
-                    if valueAmount == '0.00':
-                        print("Value = 0: " + str(omb["clean_id"][trans]))
-                    transDescList = list()
-                    transDescList.append(str(omb["Award Transaction - Description"][trans]))
-                    transDescList.append('')
-                    transType = str(omb["Award Transaction Type"][trans])
-                    if transType == "Commitment" or transType == "Obligation":
-                        transaction_code = '2'
-                    elif transType == "Disbursement":
-                        transaction_code = '3'
-                    else:
-                        transaction_code = '0'
+                        flowType = '0'
                     try:
-                        valuedate = str(int(omb["Award Transaction Date"][trans]))
-                        value_datetime = valuedate[0:4] + '-' + valuedate[4:6] + \
-                            '-' + valuedate[6:8]
+                        financeType = str(int(row.Finance_Type))
                     except ValueError:
-                        value_datetime = str(int(datetime.datetime.utcnow().strftime('%Y'))-1) + '-10-01'
-                    regAccCode = str(int(omb["Treasury Regular Account Code"][trans]))
-                    mainAccCode = str(int(omb["Treasury Main Account Code"][trans]))
-                    mainText = str(omb["Treasury Main Account Title"][trans])
+                        financeType = '0'
                     try:
-                        fundingYearBegin = \
-                            str(int(omb["Beginning Fiscal Funding Year"][trans]))
+                        aidType = str(row.Aid_Type_Code)
                     except ValueError:
-                        fundingYearBegin = str(int(datetime.datetime.utcnow().strftime('%Y'))-1)
+                        aidType = '0'
                     try:
-                        fundingYearEnd = \
-                            str(int(omb["Ending Fiscal Funding Year"][trans]))
+                        tiedCode = str(int(row.Tying_Status_of_Award))
                     except ValueError:
-                        fundingYearEnd = str(datetime.datetime.utcnow().strftime('%Y'))
-                    transId = str(omb["Award Transaction ID"][trans])
-
-                    transaction = ''
-                    # Make sure there is exactly 1 transaction value of 0.00 for Com if needed
-                    if transaction_code == '2':
-                        if (comMarker is True and valueAmount != '0.00') or\
-                                (comMarker is False and valueAmount == '0.00'):
-                            # Set the elements
-                            try:
-                                if str(int(omb["Humanitarian Tag"][trans])) == '1':
-                                    transaction = SubElement(activity, 'transaction', ref=transId, humanitarian='1')
-                                else:
-                                    transaction = SubElement(activity, 'transaction')
-                            except ValueError:
+                        tiedCode = '0'
+                    # This is for error checking
+                    periodStartDate = row.period_start_iso
+                    periodEndDate = row.period_end_iso
+                    budgetValueDate = periodStartDate
+                    budgetAmount = row.budget_amount
+                    budgetStatus = "1"
+
+                    # Create the pre-transaction types element tree
+                    collaboration_type = SubElement(activity, 'collaboration-type',
+                                                    code=collabCode)
+                    if flowType != '0':
+                        default_flow_type = SubElement(activity, 'default-flow-type',
+                                                       code=flowType)
+                    if financeType != '0':
+                        default_finance_type = SubElement(activity, 'default-finance-type',
+                                                          code=financeType)
+                    if aidType != '0':
+                        default_aid_type = SubElement(activity, 'default-aid-type',
+                                                      code=aidType)
+                    if tiedCode != '0':
+                        default_tied_status = SubElement(activity, 'default-tied-status',
+                                                         code=tiedCode)
+
+                    # Budget block
+                    if budgetAmount != '0.00':
+                        budget = SubElement(activity, 'budget', status=budgetStatus)
+                        SubElement(budget, 'period-start', {'iso-date': periodStartDate})
+                        SubElement(budget, 'period-end', {'iso-date': periodEndDate})
+                        budgetValue = SubElement(budget, 'value',
+                                                 {'currency': cur, 'value-date': budgetValueDate})
+                        budgetValue.text = budgetAmount
+
+                    # Create the list of transactions for a specific activity
+                    # histList = trans_loop(histdict, idawards[relact])
+                    histList = histdict.get((award_id, countryinit), [])
+                    transList = transdict[idawards[relact]]
+
+                    # These two make it easier to determine
+                    # if a 0 has been put in for com/dis
+                    # If changed to True, then a 0 transaction will not be put into XML
+                    comMarker = True
+                    disMarker = True
+
+                    # Loop through the historical transactions
+                    for trans in histList:
+
+                        transaction = ''
+                        valueAmount = trans[1]
+                        transType = trans[0]
+                        if transType == "Commitment" or transType == "Obligation":
+                            transaction_code = '2'
+                        elif transType == "Disbursement":
+                            transaction_code = '3'
+                        else:
+                            transaction_code = '0'
+                        value_datetime = trans[2]
+                        # Make sure there is exactly 1 transaction value of 0.00 for Com if needed
+                        if transaction_code == '2':
+                            if (comMarker is True and valueAmount != '0.00')\
+                                    or (comMarker is False and valueAmount == '0.00'):
+                                # Set the elements
                                 transaction = SubElement(activity, 'transaction')
-                            transaction_type = SubElement(transaction, 'transaction-type',
-                                                          code=transaction_code)
-                            transaction_date = SubElement(transaction, 'transaction-date',
-                                                          iso_h_date=value_datetime)
-                            value = SubElement(transaction, 'value',
-                                               value_h_date=value_datetime)
-                            value.text = valueAmount
-                            transDescription = SubElement(transaction, 'description')
-                            lang_loop(transDescription, langList, transDescList)
-
+                                transaction_type = SubElement(transaction, 'transaction-type',
+                                                              code=transaction_code)
+                                transaction_date = SubElement(transaction, 'transaction-date',
+                                                              {'iso-date': value_datetime})
+                                value = SubElement(transaction, 'value',
+                                                   {'value-date': value_datetime})
+                                value.text = valueAmount
+
+                            if str(int(trans[3])) != '0':
+                                transaction.append(constant('sector', {'code': str(int(trans[3])), 'vocabulary': '1'}))
+                            # Cluster Codes
+                            # TODO: adjust the cluster code column name
                             try:
-                                disbChan = str(int(omb["Disbursement Channel"][trans]))
+                                clusters = ""
+                                # clusters = str(omb["cluster_codes"][trans])
                             except ValueError:
-                                disbChan = '0'
+                                clusters = ""
 
-                            # Sectors
-                            try:
-                                dacCode = str(int(omb["DAC Purpose Code"][trans]))
-                            except ValueError:
-                                dacCode = '0'
-                            try:
-                                sectorCode = str(int(omb["U.S. Government Sector Code"][trans]))
-                            except ValueError:
-                                sectorCode = '0'
-                            dacVocab = '1'
-                            dacText = str(omb["DAC Purpose Name"][trans])
-                            sectorVocab = '99'
-                            sectorText = str(omb["U.S. Government Sector Name"][trans])
-
-                            # Create the element tree
-                            disburseChannel = SubElement(transaction, 'disbursement-channel', code=disbChan)
-                            if dacCode != '0':
-                                sector = SubElement(transaction, 'sector',
-                                                    code=dacCode, vocabulary=dacVocab)
-                                narrative = SubElement(sector, 'narrative')
-                                narrative.text = dacText
-                            sector = SubElement(transaction, 'sector',
-                                                code=sectorCode, vocabulary=sectorVocab)
-                            narrative = SubElement(sector, 'narrative')
-                            narrative.text = sectorText
+                            if clusters != "" and clusters != "nan":
+                                cluster_loop(clusters, transaction)
 
+                        # Make sure there is exactly 1 transaction value of 0.00 for Disb if needed
+                        if transaction_code == '3':
+                            if (disMarker is True and valueAmount != 0) or (
+                                    disMarker is False and valueAmount == 0):
+                                # Set the elements
+                                transaction = SubElement(activity, 'transaction')
+                                transaction_type = SubElement(transaction, 'transaction-type',
+                                                              code=transaction_code)
+                                transaction_date = SubElement(transaction, 'transaction-date',
+                                                              {'iso-date': value_datetime})
+                                value = SubElement(transaction, 'value',
+                                                   {'value-date': value_datetime})
+                                value.text = valueAmount
+
+                            # DAC Sectors
+                            if str(int(trans[3])) != '0':
+                                transaction.append(constant('sector', {'code': str(int(trans[3])), 'vocabulary': '1'}))
+                            # Cluster Codes
+                            # TODO: adjust the cluster code column name
                             try:
-                                if str(int(omb["Humanitarian Tag"][trans])) == '1':
-                                    cluster = str(int(omb["Cluster ID"][trans]))
-                                    if cluster != 'nan':
-                                        clusterSector = SubElement(transaction, 'sector',
-                                                                   code=cluster, vocabulary='10')
+                                clusters = ""
+                                # clusters = str(omb["cluster_codes"][trans])
                             except ValueError:
-                                cluster = '0'
-
-                            treasury_account = \
-                                SubElement(transaction, 'usg__treasury-account')
-                            regular_account = SubElement(treasury_account,
-                                                         'usg__regular-account',
-                                                         code=regAccCode)
-                            main_account = SubElement(treasury_account, 'usg__main-account',
-                                                      code=mainAccCode)
-                            main_account.text = mainText
-                            fiscal_funding_year = SubElement(treasury_account,
-                                                             'usg__fiscal-funding-year',
-                                                             begin=fundingYearBegin,
-                                                             end=fundingYearEnd)
-                        comMarker = True
-
-                    # Make sure there is exactly 1 transaction value of 0.00 for Disb if needed
-                    if transaction_code == '3':
-                        if (disMarker is True and valueAmount != 0) or (disMarker is False and valueAmount == 0):
-                            # Set the elements
-                            try:
-                                if str(int(omb["Humanitarian Tag"][trans])) == '1':
+                                clusters = ""
+
+                            if clusters != "" and clusters != "nan":
+                                cluster_loop(clusters, transaction)
+
+                    # Loop through the transactions related to the activity
+                    for trans in transList:
+                        transrow = rows[trans]
+                        # Variables that depend on entries
+                        # If the disbursement has a value, set value to disbursement.
+                        valueAmount = transrow.transaction_amount
+                        if valueAmount == '0.00':
+                            print("Value = 0: " + str(transrow.clean_id))
+                        transDescList = list()
+                        transDescList.append(str(transrow.Award_Transaction_Description))
+                        transDescList.append('')
+                        transType = str(transrow.Award_Transaction_Type)
+                        if transType == "Commitment" or transType == "Obligation":
+                            transaction_code = '2'
+                        elif transType == "Disbursement":
+                            transaction_code = '3'
+                        else:
+                            transaction_code = '0'
+                        value_datetime = transrow.transaction_date_iso
+                        regAccCode = str(int(transrow.Treasury_Regular_Account_Code))
+                        mainAccCode = str(int(transrow.Treasury_Main_Account_Code))
+                        mainText = str(transrow.Treasury_Main_Account_Title)
+                        fundingYearBegin = transrow.funding_year_begin
+                        fundingYearEnd = transrow.funding_year_end
+                        transId = str(transrow.Award_Transaction_ID)
+                        try:
+                            humanitarianTag = str(int(transrow.Humanitarian_Tag))
+                        except ValueError:
+                            humanitarianTag = '0'
+
+                        transaction = ''
+                        # Make sure there is exactly 1 transaction value of 0.00 for Com if needed
+                        if transaction_code == '2':
+                            if (comMarker is True and valueAmount != '0.00') or\
+                                    (comMarker is False and valueAmount == '0.00'):
+                                # Set the elements
+                                if humanitarianTag == '1':
                                     transaction = SubElement(activity, 'transaction', ref=transId, humanitarian='1')
                                 else:
                                     transaction = SubElement(activity, 'transaction')
-                            except ValueError:
-                                transaction = SubElement(activity, 'transaction')
-                            transaction_type = SubElement(transaction, 'transaction-type',
-                                                          code=transaction_code)
-                            transaction_date = SubElement(transaction, 'transaction-date',
-                                                          iso_h_date=value_datetime)
-                            value = SubElement(transaction, 'value',
-                                               value_h_date=value_datetime)
-                            value.text = valueAmount
-                            transDescription = SubElement(transaction, 'description')
-                            lang_loop(transDescription, langList, transDescList)
-
-                            # TODO: Adjust objective description so that only one shows up in an activity
-                            # if actObj != 'nan' and actObj != '':
-                            #    transObjective = SubElement(transaction, 'description', type='2')
-                            #    narrative = SubElement(transObjective, 'narrative')
-                            #    narrative.text = str(omb["Activity Objective"][trans])
+                                transaction_type = SubElement(transaction, 'transaction-type',
+                                                              code=transaction_code)
+                                transaction_date = SubElement(transaction, 'transaction-date',
+                                                              {'iso-date': value_datetime})
+                                value = SubElement(transaction, 'value',
+                                                   {'value-date': value_datetime})
+                                value.text = valueAmount
+                                transDescription = SubElement(transaction, 'description')
+                                lang_loop(transDescription, langList, transDescList)
+
+                                try:
+                                    disbChan = str(int(transrow.Disbursement_Channel))
+                                except ValueError:
+                                    disbChan = '0'
+
+                                # Sectors
+                                try:
+                                    dacCode = str(int(transrow.DAC_Purpose_Code))
+                                except ValueError:
+                                    dacCode = '0'
+                                try:
+                                    sectorCode = str(int(transrow.U_S_Government_Sector_Code))
+                                except ValueError:
+                                    sectorCode = '0'
+                                dacVocab = '1'
+                                dacText = str(transrow.DAC_Purpose_Name)
+                                sectorVocab = '99'
+                                sectorText = str(transrow.U_S_Government_Sector_Name)
+
+                                # Create the element tree
+                                disburseChannel = SubElement(transaction, 'disbursement-channel', code=disbChan)
+                                if dacCode != '0':
+                                    transaction.append(constant('sector',
+                                                                {'code': dacCode, 'vocabulary': dacVocab}, dacText))
+                                transaction.append(constant('sector',
+                                                            {'code': sectorCode, 'vocabulary': sectorVocab},
+                                                            sectorText))
+
+                                if humanitarianTag == '1':
+                                    try:
+                                        cluster = str(int(transrow.Cluster_ID))
+                                        if cluster != 'nan':
+                                            transaction.append(constant('sector',
+                                                                        {'code': cluster, 'vocabulary': '10'}))
+                                    except ValueError:
+                                        cluster = '0'
+
+                                treasury_account = \
+                                    SubElement(transaction, usg + 'treasury-account')
+                                regular_account = SubElement(treasury_account,
+                                                             usg + 'regular-account',
+                                                             code=regAccCode)
+                                main_account = SubElement(treasury_account, usg + 'main-account',
+                                                          code=mainAccCode)
+                                main_account.text = mainText
+                                fiscal_funding_year = SubElement(treasury_account,
+                                                                 usg + 'fiscal-funding-year',
+                                                                 begin=fundingYearBegin,
+                                                                 end=fundingYearEnd)
+                            comMarker = True
+
+                        # Make sure there is exactly 1 transaction value of 0.00 for Disb if needed
+                        if transaction_code == '3':
+                            if (disMarker is True and valueAmount != 0) or (disMarker is False and valueAmount == 0):
+                                # Set the elements
+                                if humanitarianTag == '1':
+                                    transaction = SubElement(activity, 'transaction', ref=transId, humanitarian='1')
+                                else:
+                                    transaction = SubElement(activity, 'transaction')
+                                transaction_type = SubElement(transaction, 'transaction-type',
+                                                              code=transaction_code)
+                                transaction_date = SubElement(transaction, 'transaction-date',
+                                                              {'iso-date': value_datetime})
+                                value = SubElement(transaction, 'value',
+                                                   {'value-date': value_datetime})
+                                value.text = valueAmount
+                                transDescription = SubElement(transaction, 'description')
+                                lang_loop(transDescription, langList, transDescList)
+
+                                # TODO: Adjust objective description so that only one shows up in an activity
+                                # if actObj != 'nan' and actObj != '':
+                                #    transObjective = SubElement(transaction, 'description', type='2')
+                                #    narrative = SubElement(transObjective, 'narrative')
+                                #    narrative.text = str(omb["Activity Objective"][trans])
+
+                                try:
+                                    disbChan = str(int(transrow.Disbursement_Channel))
+                                except ValueError:
+                                    disbChan = '0'
+
+                                # Sectors
+                                try:
+                                    dacCode = str(int(transrow.DAC_Purpose_Code))
+                                except ValueError:
+                                    dacCode = '0'
+                                try:
+                                    sectorCode = str(int(transrow.U_S_Government_Sector_Code))
+                                except ValueError:
+                                    sectorCode = '0'
+                                dacVocab = '1'
+                                dacText = str(transrow.DAC_Purpose_Name)
+                                sectorVocab = '99'
+                                sectorText = str(transrow.U_S_Government_Sector_Name)
+
+                                # Create the element tree
+                                disburseChannel = SubElement(transaction, 'disbursement-channel', code=disbChan)
+                                if dacCode != '0':
+                                    transaction.append(constant('sector',
+                                                                {'code': dacCode, 'vocabulary': dacVocab}, dacText))
+                                transaction.append(constant('sector',
+                                                            {'code': sectorCode, 'vocabulary': sectorVocab},
+                                                            sectorText))
+
+                                if humanitarianTag == '1':
+                                    try:
+                                        cluster = str(int(transrow.Cluster_ID))
+                                        if cluster != 'nan':
+                                            transaction.append(constant('sector',
+                                                                        {'code': cluster, 'vocabulary': '10'}))
+                                    except ValueError:
+                                        cluster = '0'
+
+                                treasury_account = \
+                                    SubElement(transaction, usg + 'treasury-account')
+                                regular_account = SubElement(treasury_account,
+                                                             usg + 'regular-account',
+                                                             code=regAccCode)
+                                main_account = SubElement(treasury_account, usg + 'main-account',
+                                                          code=mainAccCode)
+                                main_account.text = mainText
+                                fiscal_funding_year = SubElement(treasury_account,
+                                                                 usg + 'fiscal-funding-year',
+                                                                 begin=fundingYearBegin,
+                                                                 end=fundingYearEnd)
+                            disMarker = True
+
+                    # Populate the document links
+                    if clean_id != 'nan':
+                        for doc in docsList:
+                            # FIX: url and format get flipped somehow?
+                            document = SubElement(activity, 'document-link', format=doc[2], url=doc[1])
+                            title = SubElement(document, 'title')
+                            narrative = SubElement(title, 'narrative')
+                            narrative.text = doc[0]
+                            category = SubElement(document, 'category', code=doc[3])
+                            lang = SubElement(document, 'language', code=doc[4])
+                            if doc[5] != '':
+                                docdate = SubElement(document, 'document-date', {'iso-date': doc[5]})
+                    # conditionsDocument = str(omb["Conditions Document Link"][relact])
+                    # if conditionsDocument != 'nan':
+                    #     if conditionsDocument == "https://www.usaid.gov/sites/default/files/documents/1868/302.pdf":
+                    #         conditionsDocumentTitle = "ADS Chapter 302 USAID Direct Contracting"
+                    #     elif conditionsDocument == "https://www.usaid.gov/sites/default/files/documents/1868/303.pdf":
+                    #         conditionsDocumentTitle = \
+                    #             "ADS Chapter 303 Grants and Cooperative Agreements to Non-Governmental Organizations"
+                    #     conditionsAttached = "1"
+                    #     document = SubElement(activity, 'document-link', format="application/pdf",
+                    #                           url=conditionsDocument)
+                    #     title = SubElement(document, 'title')
+                    #     narrative = SubElement(title, 'narrative')
+                    #     narrative.text = conditionsDocumentTitle
+                    #     category = SubElement(document, 'category', code="A04")
+                    #     lang = SubElement(document, 'language', code="en")
+                    # else:
+                    conditionsAttached = "0"
+
+                    # TODO: Insert code for Contract Links here
+                    # document-link code=A11
+                    # Concatenate "https://www.usaspending.gov/Pages/AdvancedSearch.aspx?k=" + field
+                    # if str(omb["stripped award"][relact]) != nan:
+                    #  contractlink = (link) + str(omb["stripped award"][relact])
+                    #  contract = subelement(activity, 'document-link', format=html, url=contractlink)
+                    #  subelement(contract, 'category', code="A11")
+                    #  subelement(contract, 'language', code="en")
+
+                    # This assumes that there will never be any conditions.
+                    # This is currently the case, however, this may eventually change.
+                    activity.append(constant('conditions', {'attached': conditionsAttached}))
+
+                    for res in resList:
+                        if res[1] != 'nan':
+                            resulting = SubElement(activity, 'result', type='9')
+                            resulttitle = SubElement(resulting, 'title')
+                            narrative = SubElement(resulttitle, 'narrative')
+                            narrative.text = res[1]
+                            if res[0] != 'nan':
+                                resultdescription = SubElement(resulting, 'description')
+                                narrative = SubElement(resultdescription, 'narrative')
+                                narrative.text = res[0]
+                            if res[2] != 'nan':
+                                resultindicator = SubElement(resulting, 'indicator', measure='5')
+                                indicatortitle = SubElement(resultindicator, 'title')
+                                narrative = SubElement(indicatortitle, 'narrative')
+                                narrative.text = res[2]
+
+                    SubElement(activity, usg + 'mechanism-signing-date',
+                               {'iso-date': signdateformat})
+
+                    # Extra fields requested by State
+                    try:
+                        duns = str(int(row.Implementing_Agent_s_DUNS_Number))
+                    except ValueError:
+                        duns = 'nan'
+                    tec = row.tec_amount
+                    stateloc = str(row.State_Location)
+                    if stateloc == "CÃ´te d'Ivoire":
+                        stateloc = "Côte d'Ivoire"
+                    elif stateloc == "Lao Peopleâ€™s Democratic Republic":
+                        stateloc = "Lao People's Democratic Republic"
+
+                    if duns != 'nan':
+                        dunselement = SubElement(activity, usg + 'duns-number')
+                        narrative = SubElement(dunselement, 'narrative')
+                        narrative.text = duns
+                    if tec != 'nan':
+                        tecelement = SubElement(activity, usg + 'tec1')
+                        narrative = SubElement(tecelement, 'narrative')
+                        narrative.text = tec
+                    if stateloc != 'nan':
+                        stateelement = SubElement(activity, usg + 'state-location')
+                        narrative = SubElement(stateelement, 'narrative')
+                        narrative.text = stateloc
+
+                    # Hand the finished activity over to be written, so only one activity is held at a time
+                    yield activity
+
+        c += 1
+
+
+def write_activities(ombActs, filename, tables):
+    """
+    Write the XML file for a group of rows, writing each activity as soon as it is built.
+    :param ombActs: The rows to build the activities of.
+    :param filename: The file to write.
+    :param tables: The tables the main run made from the input files.
+    :return written: The number of activities in the file.
+    """
+    ver = '2.03'
+
+    activities = Element('iati-activities', {'version': ver, 'generated-datetime': tables['date']})
+    output_file = open(filename, 'w', encoding='utf-8')
+
+    # The activities are written as they are finished, after the root's start tag
+    written = 0
+    for activity in build_activities(ombActs, tables):
+        if not written:
+            output_file.write(prettify_start(activities))
+        output_file.write(prettify_activity(activity))
+        written += 1
+
+    # Close the root, or write it on its own if there were no activities
+    if written:
+        output_file.write('</' + activities.tag + '>\n')
+    else:
+        output_file.write(prettify_start(activities, close=True))
+    output_file.close()
+    return written
 
-                            try:
-                                disbChan = str(int(omb["Disbursement Channel"][trans]))
-                            except ValueError:
-                                disbChan = '0'
 
-                            # Sectors
-                            try:
-                                dacCode = str(int(omb["DAC Purpose Code"][trans]))
-                            except ValueError:
-                                dacCode = '0'
-                            try:
-                                sectorCode = str(int(omb["U.S. Government Sector Code"][trans]))
-                            except ValueError:
-                                sectorCode = '0'
-                            dacVocab = '1'
-                            dacText = str(omb["DAC Purpose Name"][trans])
-                            sectorVocab = '99'
-                            sectorText = str(omb["U.S. Government Sector Name"][trans])
-
-                            # Create the element tree
-                            disburseChannel = SubElement(transaction, 'disbursement-channel', code=disbChan)
-                            if dacCode != '0':
-                                sector = SubElement(transaction, 'sector',
-                                                    code=dacCode, vocabulary=dacVocab)
-                                narrative = SubElement(sector, 'narrative')
-                                narrative.text = dacText
-                            sector = SubElement(transaction, 'sector',
-                                                code=sectorCode, vocabulary=sectorVocab)
-                            narrative = SubElement(sector, 'narrative')
-                            narrative.text = sectorText
+def start_pool(tables, workers):
+    """
+    Start a pool of worker processes that can read the tables the main run made.
+    On Linux the workers are forked from the main run and read its tables in place, without being sent a copy. The
+    garbage collector is frozen first, since it would otherwise write to every table and make each worker copy them.
+    Elsewhere fork is not safe to use, so as on macOS and Windows each worker is sent its own copy of the tables.
+    :param tables: The tables the main run made from the input files.
+    :param workers: The number of worker processes.
+    :return pool: The pool. Call release_tables once it is shut down.
+    """
+    global worker_tables
+    if sys.platform.startswith('linux'):
+        worker_tables = tables
+        gc.freeze()
+        return concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+    return concurrent.futures.ProcessPoolExecutor(workers, initializer=start_worker, initargs=(tables,))
 
-                            try:
-                                if str(int(omb["Humanitarian Tag"][trans])) == '1':
-                                    cluster = str(int(omb["Cluster ID"][trans]))
-                                    if cluster != 'nan':
-                                        clusterSector = SubElement(transaction, 'sector',
-                                                                   code=cluster, vocabulary='10')
-                            except ValueError:
-                                cluster = '0'
-
-                            treasury_account = \
-                                SubElement(transaction, 'usg__treasury-account')
-                            regular_account = SubElement(treasury_account,
-                                                         'usg__regular-account',
-                                                         code=regAccCode)
-                            main_account = SubElement(treasury_account, 'usg__main-account',
-                                                      code=mainAccCode)
-                            main_account.text = mainText
-                            fiscal_funding_year = SubElement(treasury_account,
-                                                             'usg__fiscal-funding-year',
-                                                             begin=fundingYearBegin,
-                                                             end=fundingYearEnd)
-                        disMarker = True
-
-                # Populate the document links
-                if clean_id != 'nan':
-                    if clean_id in docdict:
-                        docsList = docs_loop(doc_file, clean_id, docdict)
-                    else:
-                        docsList = []
-                    for doc in docsList:
-                        # FIX: url and format get flipped somehow?
-                        document = SubElement(activity, 'document-link', format=doc[2], url=doc[1])
-                        title = SubElement(document, 'title')
-                        narrative = SubElement(title, 'narrative')
-                        narrative.text = doc[0]
-                        category = SubElement(document, 'category', code=doc[3])
-                        lang = SubElement(document, 'language', code=doc[4])
-                        if doc[5] != '':
-                            docdate = SubElement(document, 'document-date', iso_h_date=doc[5])
-                # conditionsDocument = str(omb["Conditions Document Link"][relact])
-                # if conditionsDocument != 'nan':
-                #     if conditionsDocument == "https://www.usaid.gov/sites/default/files/documents/1868/302.pdf":
-                #         conditionsDocumentTitle = "ADS Chapter 302 USAID Direct Contracting"
-                #     elif conditionsDocument == "https://www.usaid.gov/sites/default/files/documents/1868/303.pdf":
-                #         conditionsDocumentTitle = \
-                #             "ADS Chapter 303 Grants and Cooperative Agreements to Non-Governmental Organizations"
-                #     conditionsAttached = "1"
-                #     document = SubElement(activity, 'document-link', format="application/pdf",
-                #                           url=conditionsDocument)
-                #     title = SubElement(document, 'title')
-                #     narrative = SubElement(title, 'narrative')
-                #     narrative.text = conditionsDocumentTitle
-                #     category = SubElement(document, 'category', code="A04")
-                #     lang = SubElement(document, 'language', code="en")
-                # else:
-                conditionsAttached = "0"
-
-                # TODO: Insert code for Contract Links here
-                # document-link code=A11
-                # Concatenate "https://www.usaspending.gov/Pages/AdvancedSearch.aspx?k=" + field
-                # if str(omb["stripped award"][relact]) != nan:
-                #  contractlink = (link) + str(omb["stripped award"][relact])
-                #  contract = subelement(activity, 'document-link', format=html, url=contractlink)
-                #  subelement(contract, 'category', code="A11")
-                #  subelement(contract, 'language', code="en")
-
-                # This assumes that there will never be any conditions.
-                # This is currently the case, however, this may eventually change.
-                conditions = SubElement(activity, 'conditions', attached=conditionsAttached)
-
-                for res in resList:
-                    if res[1] != 'nan':
-                        resulting = SubElement(activity, 'result', type='9')
-                        resulttitle = SubElement(resulting, 'title')
-                        narrative = SubElement(resulttitle, 'narrative')
-                        narrative.text = res[1]
-                        if res[0] != 'nan':
-                            resultdescription = SubElement(resulting, 'description')
-                            narrative = SubElement(resultdescription, 'narrative')
-                            narrative.text = res[0]
-                        if res[2] != 'nan':
-                            resultindicator = SubElement(resulting, 'indicator', measure='5')
-                            indicatortitle = SubElement(resultindicator, 'title')
-                            narrative = SubElement(indicatortitle, 'narrative')
-                            narrative.text = res[2]
-
-                SubElement(activity, 'usg__mechanism-signing-date',
-                           iso_h_date=signdateformat)
-
-                # Extra fields requested by State
-                try:
-                    duns = str(int(omb["Implementing Agent's DUNS Number"][relact]))
-                except ValueError:
-                    duns = 'nan'
-                tec = str('{0:.2f}'.format(float(omb["TEC"][relact])))
-                stateloc = str(omb["State Location"][relact])
-                if stateloc == "CÃ´te d'Ivoire":
-                    stateloc = "Côte d'Ivoire"
-                elif stateloc == "Lao Peopleâ€™s Democratic Republic":
-                    stateloc = "Lao People's Democratic Republic"
-
-                if duns != 'nan':
-                    dunselement = SubElement(activity, 'usg__duns-number')
-                    narrative = SubElement(dunselement, 'narrative')
-                    narrative.text = duns
-                if tec != 'nan':
-                    tecelement = SubElement(activity, 'usg__tec1')
-                    narrative = SubElement(tecelement, 'narrative')
-                    narrative.text = tec
-                if stateloc != 'nan':
-                    stateelement = SubElement(activity, 'usg__state-location')
-                    narrative = SubElement(stateelement, 'narrative')
-                    narrative.text = stateloc
-
-    c += 1
-
-# End of run processing and time keeping stats.
-converttime = time.time() - curtime
-print('Writing file...')
-
-# This is to write to a singular file.
-# output_file = open('iati-activities-full.xml', 'w', encoding='utf-8')
-
-if not os.path.exists('export/' + time.strftime("%m-%d-%Y") + '/'):
-    os.makedirs('export/' + time.strftime("%m-%d-%Y") + '/')
-# This line is for country names
-# TODO: int(ombActs[1]) <-> int(act)
-output_file = open('export/' + time.strftime("%m-%d-%Y")+'/iati-activities-Humanitarian.xml',
-                    'w', encoding='utf-8')
-# output_file = open('export/' + time.strftime("%m-%d-%Y") + '/iati-activities-' +
-#                  str(omb["Country File Name"][int(ombActs[1])])+'.xml', 'w', encoding='utf-8')
-# This line is for country codes
-# output_file = open('export/' + time.strftime("%m-%d-%Y") +
-# '/iati-activities-'+ombActs[0]+'.xml', 'w', encoding='utf-8')
-output_file.write(prettify(activities).replace("__", ":").replace("_h_", "-"))
-output_file.close()
-
-finaltime = time.time() - curtime
-print('Opening Time: ' + str(opentime))
-print('Convert Time: ' + str(converttime - opentime))
-print('Write Time: ' + str(finaltime - converttime))
-print('Run time: ' + str(finaltime))
-print('Average time per main activity: ' +
-      str((converttime - opentime)/len(ombActs)))
-# print('Files left: ' + str(len(ombActs)))
-print('Zipping...')
-shutil.make_archive('export/zip/export-'+time.strftime("%m-%d-%Y"), 'zip', 'export/' + time.strftime("%m-%d-%Y") + '/')
-print('Complete!')
+
+def start_worker(tables):
+    """
+    Give a worker process that was not forked the tables the main run made, so it can write any group's file.
+    :param tables: The tables the main run made from the input files.
+    :return: N/A
+    """
+    global worker_tables
+    worker_tables = tables
+
+
+def release_tables():
+    """
+    Let the garbage collector look at the tables again, once the workers are finished.
+    :return: N/A
+    """
+    gc.unfreeze()
+
+
+def write_group(job):
+    """
+    Write one group's file in a worker process, to a temporary file that write_groups moves into place.
+    :param job: The (number, rows, file name) of the group.
+    :return: The temporary file, the number of activities, the seconds it took and the error, if there was one.
+    """
+    number, ombActs, filename = job
+    start = time.time()
+    temporary = filename + '.' + str(number) + '.tmp'
+    try:
+        written = write_activities(ombActs, temporary, worker_tables)
+    except Exception:
+        return temporary, 0, time.time() - start, traceback.format_exc()
+    return temporary, written, time.time() - start, None
+
+
+def render_activities(acts):
+    """
+    Build and print a run of hierarchy 1 activities and their related activities in a worker process.
+    :param acts: The hierarchy 1 rows to build the activities of.
+    :return: The printed activities and the number of them.
+    """
+    printed = [prettify_activity(activity) for activity in build_activities(acts, worker_tables, c=2)]
+    return ''.join(printed), len(printed)
+
+
+def write_fragments(ombActs, filename, tables, workers):
+    """
+    Write the XML file for a group of rows, with the activities built and printed by a pool of worker processes.
+    The printed activities are written in the order of the rows, and each worker only has a few runs of them
+    waiting to be written at a time. The file is written under a temporary name and only moved into place once it is
+    finished, so a run that fails leaves nothing behind.
+    :param ombActs: The rows to build the activities of.
+    :param filename: The file to write.
+    :param tables: The tables the main run made from the input files.
+    :param workers: The number of worker processes.
+    :return written, error: The number of activities in the file, and the error if it could not be written.
+    """
+    ver = '2.03'
+
+    activities = Element('iati-activities', {'version': ver, 'generated-datetime': tables['date']})
+    temporary = filename + '.tmp'
+    output_file = open(temporary, 'w', encoding='utf-8')
+
+    # Only the hierarchy 1 rows make activities, so the runs are made of those
+    h1acts = tables['h1acts']
+    acts = [act for act in list(ombActs) if act in h1acts]
+
+    written = 0
+    error = None
+    waiting = collections.deque()
+    pool = start_pool(tables, workers)
+    try:
+        for start in range(0, len(acts), run_size):
+            waiting.append(pool.submit(render_activities, acts[start:start + run_size]))
+            # Write the oldest runs once the workers have enough queued, and all of them after the last is handed out
+            last = start + run_size >= len(acts)
+            while waiting and (last or len(waiting) >= workers * runs_per_worker):
+                printed, count = waiting.popleft().result()
+                if count and not written:
+                    output_file.write(prettify_start(activities))
+                output_file.write(printed)
+                written += count
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        # If a run failed, the runs still waiting are dropped instead of built
+        pool.shutdown(cancel_futures=True)
+        release_tables()
+
+    if error:
+        output_file.close()
+        os.remove(temporary)
+        return written, error
+    # Close the root, or write it on its own if there were no activities
+    if written:
+        output_file.write('</' + activities.tag + '>\n')
+    else:
+        output_file.write(prettify_start(activities, close=True))
+    output_file.close()
+    os.replace(temporary, filename)
+    return written, None
+
+
+def write_groups(ombgrouping, tables, workers):
+    """
+    Write the file of every group with a pool of worker processes.
+    Each file is moved into place in the order of the groups, so the export folder ends up the same as
+    when the groups are written one after another.
+    :param ombgrouping: The groups of rows, one for each file.
+    :param tables: The tables the main run made from the input files.
+    :param workers: The number of worker processes.
+    :return errors: The files that could not be written.
+    """
+    jobs = [(number, ombActs, output_name(ombActs)) for number, ombActs in enumerate(ombgrouping)]
+    errors = []
+    pool = start_pool(tables, workers)
+    try:
+        with pool:
+            for job, result in zip(jobs, pool.map(write_group, jobs)):
+                filename = job[2]
+                temporary, written, seconds, error = result
+                if error:
+                    print('Could not write ' + filename + ':\n' + error)
+                    if os.path.exists(temporary):
+                        os.remove(temporary)
+                    errors.append(filename)
+                    continue
+                os.replace(temporary, filename)
+                print('Wrote ' + filename + ': ' + str(written) + ' activities in ' + str(seconds) + ' seconds')
+    finally:
+        release_tables()
+    return errors
+
+
+if __name__ == '__main__':
+    curtime = time.time()
+    omb, loc_file, doc_file, hist_file, res_file = open_files(force_reparse, parallel_load)
+    opentime = time.time() - curtime
+    print('Converting format...')
+    now = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+    # Variable creation
+    idlist, idawards, isolist = id_loop(omb)
+    joined = join_files(omb, isolist, loc_file, doc_file, res_file)
+    histdict = historical_dict(hist_file)
+    omb_dates(omb)
+    omb_amounts(omb)
+    rows = omb_records(omb)
+    # This will turn on full dataset dump into one XML.
+    ombgrouping = [activities_loop(idlist)]
+
+    h1acts = activities_loop(idlist)
+    relateddict = related_dict(idlist, idawards)
+    transdict = trans_dict(idawards)
+
+    # Everything the activities are built from, so a worker process can be given all of it at once
+    tables = {'rows': rows, 'idlist': idlist, 'idawards': idawards, 'isolist': isolist, 'h1acts': h1acts,
+              'relateddict': relateddict, 'transdict': transdict, 'histdict': histdict, 'joined': joined,
+              'date': date, 'now': now}
+    if not os.path.exists('export/' + time.strftime("%m-%d-%Y") + '/'):
+        os.makedirs('export/' + time.strftime("%m-%d-%Y") + '/')
+
+    # This will turn on the splitting of the file via recipient if you uncomment this.
+    # ombgrouping = group_split(omb)
+    # Only the files whose rows have changed since the last run are built, the rest are copied from it
+    ombgrouping, manifest = plan_groups(ombgrouping, tables, force_rebuild)
+    if workers > 1 and (split_fragments or len(ombgrouping) == 1):
+        errors = []
+        for ombActs in ombgrouping:
+            print('Writing file...')
+            filename = output_name(ombActs)
+            written, error = write_fragments(ombActs, filename, tables, workers)
+            if error:
+                print('Could not write ' + filename + ':\n' + error)
+                errors.append(filename)
+        if errors:
+            sys.exit('Could not write ' + ', '.join(errors))
+        print('Run time: ' + str(time.time() - curtime))
+    elif workers > 1:
+        errors = write_groups(ombgrouping, tables, workers)
+        if errors:
+            sys.exit('Could not write ' + ', '.join(errors))
+        print('Run time: ' + str(time.time() - curtime))
+    else:
+        for ombActs in ombgrouping:
+            print('Writing file...')
+            write_activities(ombActs, output_name(ombActs), tables)
+            # End of run processing and time keeping stats.
+            finaltime = time.time() - curtime
+            print('Opening Time: ' + str(opentime))
+            print('Convert Time: ' + str(finaltime - opentime))
+            print('Run time: ' + str(finaltime))
+            print('Average time per main activity: ' +
+                  str((finaltime - opentime)/len(ombActs)))
+            # print('Files left: ' + str(len(ombActs)))
+    save_manifest(manifest)
+    print('Zipping...')
+    shutil.make_archive('export/zip/export-'+time.strftime("%m-%d-%Y"), 'zip', 'export/' + time.strftime("%m-%d-%Y") + '/')
+    print('Complete!')